@@ -0,0 +1,592 @@
+"""
+Benchmarks the Python filters of this repository against generated packs.
+
+Every benchmark case generates a synthetic project (RP, BP and data folders)
+in a temporary folder, then runs the entry point of a filter in it, in a
+separate process, the same way as Regolith does. The wall time, the peak
+memory and the number of files processed per second are written as JSON, so
+that the results of different commits can be compared.
+
+See 'readme.md' for more information.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageDraw
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+
+# Runs a filter, and saves its wall time, exit code and peak memory to the
+# file given as the first argument. The filters are started from this small
+# process instead of the benchmark itself, as Linux passes the peak memory
+# of the parent on to the child when it's started with vfork and exec.
+LAUNCHER = """
+import os, sys, json, time, subprocess
+start = time.perf_counter()
+process = subprocess.Popen(sys.argv[2:])
+_, status, usage = os.wait4(process.pid, 0)
+seconds = time.perf_counter() - start
+with open(sys.argv[1], "w") as f:
+    json.dump({
+        "seconds": seconds,
+        "returncode": os.waitstatus_to_exitcode(status),
+        "maxrss": usage.ru_maxrss,
+    }, f)
+"""
+
+
+# The alpha patterns of the generated textures, see 'write_texture'
+ALPHA_PATTERNS = ("opaque", "clean", "dirty")
+
+
+class Options(NamedTuple):
+    """
+    The options of the generated projects.
+
+    count: the number of files generated for every case
+    texture_sizes: the sizes of the textures, used in turn
+    large_texture_sizes: the sizes of the textures of the large cases
+    alpha: the alpha patterns of the textures, used in turn
+    lang_lines: the number of existing lines in the large language file
+    """
+    count: int = 1000
+    texture_sizes: Tuple[int, ...] = (16,)
+    large_texture_sizes: Tuple[int, ...] = (256,)
+    alpha: Tuple[str, ...] = ALPHA_PATTERNS
+    lang_lines: int = 50000
+
+
+class Case(NamedTuple):
+    """
+    A benchmark case.
+
+    filter: the folder of the filter in this repository
+    script: the entry point of the filter, relative to its folder
+    settings: the settings passed to the filter
+    generate: generates the project in the given folder, with the given
+        options, returns the number of files the filter works on
+    reference: another case, whose output images are compared with the
+        output images of this case, pixel by pixel
+    """
+    name: str
+    filter: str
+    script: str
+    settings: dict
+    generate: Callable[[Path, Options, random.Random], int]
+    reference: Optional[str] = None
+
+
+# -- Generators --------------------------------------------------------------
+
+def write_texture(path: Path, size: int, alpha: str, rng: random.Random) -> None:
+    """
+    Writes a random RGBA texture. The alpha pattern is one of:
+      - 'opaque': no transparent pixels
+      - 'clean': transparent pixels without color data
+      - 'dirty': transparent pixels with color data, which fix_emissive fixes
+    """
+    background = (
+        rng.randrange(256), rng.randrange(256), rng.randrange(256),
+        255 if alpha == "opaque" else 0)
+    if alpha == "clean":
+        background = (0, 0, 0, 0)
+    img = Image.new("RGBA", (size, size), background)
+    draw = ImageDraw.Draw(img)
+    for _ in range(4):
+        x, y = rng.randrange(size), rng.randrange(size)
+        draw.rectangle(
+            [x, y, x + rng.randrange(1, size), y + rng.randrange(1, size)],
+            fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256), 255))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    img.save(path)
+
+
+def texture_path(root: Path, index: int, rng: random.Random, suffix=".png") -> Path:
+    """
+    Returns the path of a texture, nested in up to three folders.
+    """
+    folders = [f"folder_{rng.randrange(8)}" for _ in range(rng.randrange(4))]
+    return root.joinpath("textures", *folders, f"texture_{index}{suffix}")
+
+
+def write_textures(project: Path, count: int, sizes: Tuple[int, ...], alpha: Tuple[str, ...], rng: random.Random) -> int:
+    """
+    Writes textures in the resource pack, using the sizes and the alpha
+    patterns in turn.
+    """
+    for i in range(count):
+        write_texture(
+            texture_path(project / "RP", i, rng), sizes[i % len(sizes)],
+            alpha[i % len(alpha)], rng)
+    return count
+
+
+def generate_textures(project: Path, options: Options, rng: random.Random) -> int:
+    return write_textures(project, options.count, options.texture_sizes, options.alpha, rng)
+
+
+def generate_large_textures(project: Path, options: Options, rng: random.Random) -> int:
+    return write_textures(
+        project, max(1, options.count // 16), options.large_texture_sizes, options.alpha, rng)
+
+
+def generate_texture_list_pack(project: Path, options: Options, rng: random.Random) -> int:
+    """
+    Generates empty textures in the resource pack and in two subpacks. The
+    filter only looks at the file names.
+    """
+    roots = [project / "RP", project / "RP/subpacks/low", project / "RP/subpacks/high"]
+    for i in range(options.count):
+        path = texture_path(rng.choice(roots), i, rng, rng.choice([".png", ".tga"]))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    return options.count
+
+
+def write_gif(path: Path, frames: int, size: int, rng: random.Random) -> None:
+    images = []
+    for _ in range(frames):
+        img = Image.new("RGB", (size, size), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        ImageDraw.Draw(img).ellipse(
+            [rng.randrange(size // 2), rng.randrange(size // 2), size - 1, size - 1],
+            fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        images.append(img)
+    images[0].save(path, save_all=True, append_images=images[1:], duration=50, loop=0)
+
+
+def write_kra(path: Path, size: int, rng: random.Random) -> None:
+    """
+    Writes a minimal Krita file, which only contains the images used by
+    texture_convert.
+    """
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("mimetype", "application/x-krita")
+        for name, image_size in (("preview.png", min(size, 256)), ("mergedimage.png", size)):
+            img = Image.new("RGBA", (image_size, image_size), (rng.randrange(256), 0, 0, 255))
+            with z.open(name, "w") as f:
+                img.save(f, format="PNG")
+
+
+def write_psd(path: Path, layers: int, size: int, rng: random.Random) -> None:
+    """
+    Writes a multi-layer PSD file with a merged composite, using psd-tools
+    (installed with layeredimage).
+    """
+    from psd_tools import PSDImage
+    from psd_tools.api.layers import PixelLayer
+
+    psd = PSDImage.new("RGBA", (size, size), color=(0, 0, 0, 0))
+    for i in range(layers):
+        img = Image.new("RGBA", (size, size), (0, 0, 0, 0) if i else (90, 120, 150, 255))
+        draw = ImageDraw.Draw(img)
+        for _ in range(6):
+            x, y = rng.randrange(size), rng.randrange(size)
+            draw.ellipse(
+                [x, y, x + rng.randrange(1, size // 2), y + rng.randrange(1, size // 2)],
+                fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256), 255))
+        PixelLayer.frompil(img, psd, name=f"Layer {i}")
+    psd.save(path)
+
+
+def generate_layered_sources(project: Path, options: Options, rng: random.Random) -> int:
+    """
+    Generates GIF, Krita and PSD files, in equal parts.
+    """
+    count = max(3, options.count // 20)
+    for i in range(count):
+        path = texture_path(project / "RP", i, rng, (".gif", ".kra", ".psd")[i % 3])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".gif":
+            write_gif(path, frames=16, size=32, rng=rng)
+        elif path.suffix == ".kra":
+            write_kra(path, size=512, rng=rng)
+        else:
+            write_psd(path, layers=4, size=128, rng=rng)
+    return count
+
+
+def generate_psd_sources(project: Path, options: Options, rng: random.Random) -> int:
+    """
+    Generates large multi-layer PSD files, to compare converting the merged
+    image with flattening the layers.
+    """
+    count = max(1, options.count // 100)
+    for i in range(count):
+        path = texture_path(project / "RP", i, rng, ".psd")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_psd(path, layers=8, size=512, rng=rng)
+    return count
+
+
+def write_json(path: Path, data) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def generate_name_ninja_pack(project: Path, options: Options, rng: random.Random, lang_lines=0) -> int:
+    """
+    Generates entities, items and blocks, some with a 'name', and en_US.lang
+    with existing translations.
+    """
+    bp = project / "BP"
+    per_type = max(1, options.count // 3)
+    for i in range(per_type):
+        description = {"identifier": f"bench:entity_{i}"}
+        if rng.random() < 0.5:
+            description["name"] = f"Entity {i}"
+        if rng.random() < 0.2:
+            description["spawn_egg_name"] = f"Entity Egg {i}"
+        write_json(bp / "entities" / f"entity_{i}.json", {
+            "format_version": "1.20.0",
+            "minecraft:entity": {
+                "description": description,
+                "components": {"minecraft:health": {"value": 20, "max": 20}},
+            },
+        })
+        description = {"identifier": f"bench:item_{i}"}
+        if rng.random() < 0.5:
+            description["name"] = f"Item {i}"
+        write_json(bp / "items" / f"item_{i}.json", {
+            "format_version": "1.20.0",
+            "minecraft:item": {"description": description, "components": {}},
+        })
+        description = {"identifier": f"bench:block_{i}"}
+        if rng.random() < 0.5:
+            description["name"] = f"Block {i}"
+        write_json(bp / "blocks" / f"block_{i}.json", {
+            "format_version": "1.20.0",
+            "minecraft:block": {"description": description, "components": {}},
+        })
+    texts = project / "RP" / "texts"
+    texts.mkdir(parents=True, exist_ok=True)
+    with open(texts / "en_US.lang", "w", encoding="utf-8") as f:
+        for i in range(lang_lines):
+            f.write(f"bench.existing_{i}.name=Existing {i}\t## comment\n")
+        for i in range(0, per_type, 4):
+            f.write(f"entity.bench:entity_{i}.name=Old Name {i}\n")
+    return per_type * 3
+
+
+def generate_name_ninja_large_lang(project: Path, options: Options, rng: random.Random) -> int:
+    return generate_name_ninja_pack(project, options, rng, lang_lines=options.lang_lines)
+
+
+def generate_bump_manifest_pack(project: Path, options: Options, rng: random.Random) -> int:
+    """
+    Generates manifests and files of random content in both packs.
+    """
+    for pack, module_type in (("RP", "resources"), ("BP", "data")):
+        write_json(project / pack / "manifest.json", {
+            "format_version": 2,
+            "header": {"name": pack, "uuid": f"{pack}-uuid", "version": [1, 0, 0]},
+            "modules": [{"type": module_type, "uuid": f"{pack}-module", "version": [1, 0, 0]}],
+        })
+        for i in range(options.count // 2):
+            path = project / pack / f"folder_{i % 16}" / f"file_{i}.bin"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(rng.randbytes(4096))
+    return options.count
+
+
+def generate_filter_tester_pack(project: Path, options: Options, rng: random.Random) -> int:
+    """
+    Generates JSON and binary files in both packs, and identical
+    expectations.
+    """
+    for i in range(options.count):
+        pack = ("RP", "BP")[i % 2]
+        relative = Path(pack, f"folder_{i % 16}")
+        if i % 4 == 0:
+            data = rng.randbytes(8192)
+            relative /= f"file_{i}.bin"
+        else:
+            data = json.dumps({
+                "format_version": "1.20.0",
+                "values": [rng.random() for _ in range(64)],
+                "nested": {"a": {"b": {"c": list(range(32))}}},
+            }, indent=2).encode()
+            relative /= f"file_{i}.json"
+        for root in (project, project / "data" / "filter_tester"):
+            path = root / relative
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+    return options.count
+
+
+CASES = [
+    Case("fix_emissive", "fix_emissive", "fix_emissive.py", {}, generate_textures),
+    Case("fix_emissive_large", "fix_emissive", "fix_emissive.py", {}, generate_large_textures),
+    Case("texture_list", "texture_list", "texture_list.py", {}, generate_texture_list_pack),
+    Case("texture_convert", "texture_convert", "texture_convert.py", {}, generate_layered_sources),
+    Case("texture_convert_psd_layers", "texture_convert", "texture_convert.py", {"cache": False, "psd": {"source": "layers"}}, generate_psd_sources),
+    Case("texture_convert_psd_composite", "texture_convert", "texture_convert.py", {"cache": False, "psd": {"source": "composite"}}, generate_psd_sources, "texture_convert_psd_layers"),
+    Case("name_ninja", "name_ninja", "name_ninja.py", {"languages": ["en_US.lang"]}, generate_name_ninja_pack),
+    Case("name_ninja_fast", "name_ninja", "name_ninja.py", {"languages": ["en_US.lang"], "fast": True}, generate_name_ninja_pack),
+    Case("name_ninja_large_lang", "name_ninja", "name_ninja.py", {"languages": ["en_US.lang"], "overwrite": True}, generate_name_ninja_large_lang),
+    Case("bump_manifest", "bump_manifest", "bump_manifest.py", {}, generate_bump_manifest_pack),
+    Case("bump_manifest_on_change", "bump_manifest", "bump_manifest.py", {"only_on_change": True}, generate_bump_manifest_pack),
+    Case("filter_tester", "filter_tester", "main.py", {"errors_stop_execution": True}, generate_filter_tester_pack),
+]
+
+
+# -- Running -----------------------------------------------------------------
+
+def run_filter(case: Case, project: Path, timeout: Optional[float]) -> dict:
+    """
+    Runs the filter in the project folder, and measures the wall time and the
+    peak memory of its process (including the worker processes it waited
+    for).
+    """
+    command = [sys.executable, str(REPO_PATH / case.filter / case.script), json.dumps(case.settings)]
+    if not hasattr(os, "wait4"):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, cwd=project, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output, _ = process.communicate()
+        return {
+            "seconds": time.perf_counter() - start,
+            "peak_rss_mb": None,
+            "returncode": process.returncode,
+            "output": output.decode("utf-8", "replace")[-2000:],
+        }
+
+    usage_path = project.with_name(f"{project.name}_usage.json")
+    process = subprocess.run(
+        [sys.executable, "-c", LAUNCHER, str(usage_path), *command],
+        cwd=project, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with open(usage_path) as f:
+        usage = json.load(f)
+    return {
+        "seconds": usage["seconds"],
+        # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+        "peak_rss_mb": usage["maxrss"] / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "returncode": usage["returncode"],
+        "output": process.stdout.decode("utf-8", "replace")[-2000:],
+    }
+
+
+def run_case(case: Case, options: Options, repeat: int, warm: bool, seed: int, timeout: Optional[float], keep: Optional[Path], output: Optional[Path] = None) -> dict:
+    """
+    Generates the project of a case once, and runs the filter on a fresh copy
+    of it 'repeat' times. With 'warm', the data folder of every run is kept
+    for the next one, to measure the caches of the filters. When an output
+    folder is given, the resource pack of the first run is copied to it.
+    """
+    with tempfile.TemporaryDirectory(prefix=f"bench_{case.name}_") as temp:
+        source = Path(temp) / "source"
+        for folder in ("RP", "BP", "data"):
+            (source / folder).mkdir(parents=True)
+        generate_start = time.perf_counter()
+        files = case.generate(source, options, random.Random(seed))
+        generate_seconds = time.perf_counter() - generate_start
+
+        runs = []
+        data = source / "data"
+        for i in range(repeat):
+            project = Path(temp) / f"run_{i}"
+            shutil.copytree(source / "RP", project / "RP")
+            shutil.copytree(source / "BP", project / "BP")
+            shutil.copytree(data, project / "data")
+            run = run_filter(case, project, timeout)
+            run["files_per_second"] = files / run["seconds"] if run["seconds"] else None
+            runs.append(run)
+            if warm:
+                data = project / "data"
+            if keep is not None:
+                shutil.copytree(project, keep / case.name / f"run_{i}", dirs_exist_ok=True)
+            if output is not None and i == 0:
+                shutil.copytree(project / "RP", output)
+
+    seconds = [run["seconds"] for run in runs]
+    failed = [run for run in runs if run["returncode"] != 0]
+    return {
+        "case": case.name,
+        "filter": case.filter,
+        "settings": case.settings,
+        "files": files,
+        "generate_seconds": generate_seconds,
+        "min_seconds": min(seconds),
+        "median_seconds": statistics.median(seconds),
+        "max_files_per_second": files / min(seconds) if min(seconds) else None,
+        "peak_rss_mb": max((run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None), default=None),
+        "failed": len(failed),
+        # The output is only kept for failed runs, to keep the results small
+        "runs": [
+            {k: v for k, v in run.items() if k != "output" or run["returncode"] != 0}
+            for run in runs
+        ],
+    }
+
+
+def compare_images(output: Path, reference: Path) -> dict:
+    """
+    Compares the PNG files of two resource packs, pixel by pixel, in RGBA.
+    """
+    images = different_images = different_pixels = max_difference = missing = 0
+    for reference_path in sorted(reference.rglob("*.png")):
+        images += 1
+        path = output / reference_path.relative_to(reference)
+        if not path.exists():
+            missing += 1
+            continue
+        with Image.open(path) as img, Image.open(reference_path) as reference_img:
+            img, reference_img = img.convert("RGBA"), reference_img.convert("RGBA")
+            if img.size != reference_img.size:
+                different_images += 1
+                continue
+            difference = ImageChops.difference(img, reference_img)
+        # The largest difference of any channel, for every pixel
+        bands = difference.split()
+        pixel_difference = bands[0]
+        for band in bands[1:]:
+            pixel_difference = ImageChops.lighter(pixel_difference, band)
+        largest = pixel_difference.getextrema()[1]
+        if largest:
+            different_images += 1
+            different_pixels += pixel_difference.point(lambda v: 255 if v else 0).histogram()[255]
+            max_difference = max(max_difference, largest)
+    return {
+        "images": images,
+        "missing": missing,
+        "different_images": different_images,
+        "different_pixels": different_pixels,
+        "max_difference": max_difference,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    defaults = Options()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "cases", nargs="*",
+        help="The cases or filters to run. All cases are run by default.")
+    parser.add_argument(
+        "-n", "--count", type=int, default=defaults.count,
+        help=f"The number of files generated for every case (default: {defaults.count}).")
+    parser.add_argument(
+        "--texture-sizes", type=int, nargs="+", default=defaults.texture_sizes,
+        help=f"The sizes of the textures, used in turn (default: {' '.join(map(str, defaults.texture_sizes))}).")
+    parser.add_argument(
+        "--large-texture-sizes", type=int, nargs="+", default=defaults.large_texture_sizes,
+        help=f"The sizes of the textures of fix_emissive_large, used in turn (default: {' '.join(map(str, defaults.large_texture_sizes))}).")
+    parser.add_argument(
+        "--alpha", nargs="+", choices=ALPHA_PATTERNS, default=defaults.alpha,
+        help="The alpha patterns of the textures, used in turn (default: all of them).")
+    parser.add_argument(
+        "--lang-lines", type=int, default=defaults.lang_lines,
+        help=f"The number of existing lines in the language file of name_ninja_large_lang (default: {defaults.lang_lines}).")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="The number of runs of every case (default: 3).")
+    parser.add_argument(
+        "--warm", action="store_true",
+        help="Keep the data folder between the runs of a case, to measure the caches.")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The seed of the generated files.")
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="Stop runs after this number of seconds (only on Windows).")
+    parser.add_argument(
+        "-o", "--output", type=Path, default=None,
+        help="The JSON file the results are written to. Printed by default.")
+    parser.add_argument(
+        "--keep", type=Path, default=None,
+        help="Copy the projects of every run to this folder, to inspect them.")
+    parser.add_argument(
+        "--list", action="store_true", help="List the cases and exit.")
+    args = parser.parse_args()
+
+    if args.list:
+        for case in CASES:
+            print(f"{case.name:28} {case.filter}")
+        return
+
+    options = Options(
+        args.count, tuple(args.texture_sizes), tuple(args.large_texture_sizes),
+        tuple(args.alpha), args.lang_lines)
+    cases = [
+        case for case in CASES
+        if not args.cases or case.name in args.cases or case.filter in args.cases
+    ]
+    if not cases:
+        parser.error(f"No case matches {', '.join(args.cases)}, see --list")
+
+    # The outputs are only kept for the cases which are compared
+    names = {case.name for case in cases}
+    compared = {
+        name for case in cases if case.reference in names
+        for name in (case.name, case.reference)
+    }
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_outputs_") as outputs:
+        outputs = Path(outputs)
+        for case in cases:
+            print(f"Running {case.name}...", file=sys.stderr)
+            output = outputs / case.name if case.name in compared else None
+            result = run_case(case, options, args.repeat, args.warm, args.seed, args.timeout, args.keep, output)
+            status = f"{result['failed']} failed run(s)" if result["failed"] else "ok"
+            rss = "" if result["peak_rss_mb"] is None else f", {result['peak_rss_mb']:.0f} MiB"
+            print(
+                f"    {result['files']} files, {result['min_seconds']:.3f} s{rss}, {status}",
+                file=sys.stderr)
+            results.append(result)
+
+        for case, result in zip(cases, results):
+            if case.reference not in names:
+                continue
+            comparison = compare_images(outputs / case.name, outputs / case.reference)
+            result["reference"] = {"case": case.reference, **comparison}
+            print(
+                f"{case.name} compared with {case.reference}: "
+                f"{comparison['different_images']} of {comparison['images']} image(s) differ, "
+                f"{comparison['different_pixels']} pixel(s), {comparison['missing']} missing",
+                file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        **options._asdict(),
+        "repeat": args.repeat,
+        "warm": args.warm,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,98 @@
 import os
+import sys
+import glob
 import json
-from typing import List
+import time
+import hashlib
+from typing import List, Optional
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from profiler import Profiler
+
+VERSION_PATH = './data/bump_manifest/version.json'
+LOCK_PATH = './data/bump_manifest/version.json.lock'
+CONTENT_HASH_PATH = './data/bump_manifest/content_hash.json'
+
+if os.name == 'nt':
+    import msvcrt
+
+    def lock_file(file) -> None:
+        # msvcrt.locking only retries for 10 seconds, so it's retried until
+        # the lock is acquired. The first byte of the file is locked.
+        file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                time.sleep(0.1)
+
+    def unlock_file(file) -> None:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def lock_file(file) -> None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(file) -> None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+def remove_lock_file() -> None:
+    try:
+        os.remove(LOCK_PATH)
+    except OSError:
+        # Already removed, or still open in another process on Windows
+        pass
+
+@contextmanager
+def version_lock():
+    """
+    Holds an exclusive lock on the version file, so that filters running in
+    parallel read and increment the version one at a time. The lock is
+    released by the system if the process dies.
+
+    The lock file is removed when the lock is released, so that it's not
+    exported with the data folder. A process which was waiting on a lock file
+    that was removed in the meantime locks a new one.
+    """
+    Path(os.path.dirname(LOCK_PATH)).mkdir(parents=True, exist_ok=True)
+    while True:
+        lock = open(LOCK_PATH, 'a')
+        lock_file(lock)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(LOCK_PATH)):
+                break
+        except FileNotFoundError:
+            pass
+        unlock_file(lock)
+        lock.close()
+    try:
+        yield
+    finally:
+        if os.name != 'nt':
+            # Removed while it's locked, so that no other process holds it
+            # once it's gone
+            remove_lock_file()
+        unlock_file(lock)
+        lock.close()
+        if os.name == 'nt':
+            # Windows can't remove a file which is open, so it's only removed
+            # when no other process is waiting for it
+            remove_lock_file()
+
+def write_json(path: str, data: dict) -> None:
+    """
+    Writes a JSON file through a temporary file, so that the file is never
+    left half written.
+    """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(temp_path, path)
 
 def create_version_file() -> None:
     """
@@ -10,32 +101,108 @@ def create_version_file() -> None:
 
     Path("./data/bump_manifest/").mkdir(parents=True, exist_ok=True)
 
-    with open('./data/bump_manifest/version.json', 'a') as file:
-        json.dump({'version': [1, 0, 0]}, file, indent=4)
+    write_json(VERSION_PATH, {'version': [1, 0, 0]})
 
-def get_version() -> str:
+def read_content_hash() -> Optional[str]:
+    """
+    Reads the content hash of the packs, from the last time the version was
+    bumped.
+    """
+
+    try:
+        with open(CONTENT_HASH_PATH, 'r') as f:
+            return json.load(f)['hash']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return None
+
+def get_version(content_hash: Optional[str] = None) -> tuple[list[int], bool]:
     """
     Gets the current version number from the version.json file.
 
-    Saves new version back to the file.
+    Saves new version back to the file. The file is locked while the version
+    is read and incremented, so no increment is lost when several profiles
+    run at the same time.
+
+    When a content hash is given, the version is only incremented if it's
+    different from the hash of the last bump. Bumps without a content hash
+    remove the saved hash.
+
+    Returns the version, and whether it was incremented.
     """
 
-    path = './data/bump_manifest/version.json'
+    with version_lock():
+        # Create version file, if it doesn't exist
+        if not os.path.exists(VERSION_PATH):
+            create_version_file()
 
-    # Create version file, if it doesn't exist
-    if not os.path.exists(path):
-        create_version_file()
+        # Read version file
+        with open(VERSION_PATH, 'r') as f:
+            data = json.load(f)
 
-    # Read version file
-    with open(path, 'r') as f:
-        data = json.load(f)
+        if content_hash is not None and content_hash == read_content_hash():
+            return data['version'], False
 
-    # Update version file
-    data['version'][-1] = data['version'][-1] + 1
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=4)
+        # Update version file
+        data['version'][-1] = data['version'][-1] + 1
+        write_json(VERSION_PATH, data)
+        if content_hash is not None:
+            write_json(CONTENT_HASH_PATH, {'hash': content_hash})
+        elif os.path.exists(CONTENT_HASH_PATH):
+            # The content of this version wasn't hashed, so the next bump
+            # with 'only_on_change' must not be skipped based on an older one
+            os.remove(CONTENT_HASH_PATH)
+
+    return data['version'], True
+
+def hash_file(path: str) -> str:
+    """
+    Hashes the content of a file, reading it in chunks.
+    """
+
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def hash_files(paths: List[str]) -> List[str]:
+    return [hash_file(path) for path in paths]
+
+def list_pack_files(packs: List[str]) -> List[str]:
+    """
+    Lists the files of the packs, sorted. The manifest files are ignored, as
+    they contain the version itself.
+    """
 
-    return data['version']
+    paths = set()
+    for pack_path in packs:
+        for root, _, files in os.walk(pack_path):
+            for name in files:
+                if name != 'manifest.json':
+                    paths.add(Path(root, name).as_posix())
+    return sorted(paths)
+
+def hash_packs(paths: List[str], workers: int) -> str:
+    """
+    Computes a hash of the content of the packs, from the paths and contents
+    of their files, listed with 'list_pack_files'.
+
+    The files are hashed in parallel batches, hashlib releases the GIL while
+    hashing.
+    """
+
+    if workers > 1 and len(paths) > 1:
+        batch_size = max(1, len(paths) // (workers * 4))
+        batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+        with ThreadPoolExecutor(workers) as executor:
+            file_hashes = [h for batch in executor.map(hash_files, batches) for h in batch]
+    else:
+        file_hashes = hash_files(paths)
+
+    content_hash = hashlib.sha256()
+    for path, file_hash in zip(paths, file_hashes):
+        content_hash.update(f'{path}\0{file_hash}\n'.encode())
+    return content_hash.hexdigest()
 
 
 def update_manifest(manifest: dict, version: list[int]) -> dict:
@@ -74,37 +241,74 @@ def update_manifest(manifest: dict, version: list[int]) -> dict:
 
     return manifest
 
-    
-def main():
-    """
-    Program execution begins here.
-    """
 
-    # Get current version, and update the file
-    version = get_version()
+def bump_pack(pack_path: str, version: list[int]) -> bool:
+    """
+    Writes the version into the manifest of a pack.
 
-    print("Pack updated to version: ", str(version))
+    Returns False if the pack has no manifest.
+    """
 
-    # Write new version to resource pack
+    path = os.path.join(pack_path, 'manifest.json')
     try:
-        with open('./RP/manifest.json', 'r') as manifest_file:
+        with open(path, 'r') as manifest_file:
             manifest = json.load(manifest_file)
-
-        with open('./RP/manifest.json', 'w') as manifest_file:
-            json.dump(update_manifest(manifest, version), manifest_file, indent=4)
     except FileNotFoundError:
-        pass
+        return False
+
+    write_json(path, update_manifest(manifest, version))
+    return True
+
+def find_packs(patterns: List[str]) -> List[str]:
+    """
+    Lists the pack folders matching the glob patterns, in order and without
+    duplicates.
+    """
+
+    packs = {}
+    for pattern in patterns:
+        for pack_path in sorted(glob.glob(pattern)):
+            if os.path.isdir(pack_path):
+                packs[os.path.normpath(pack_path)] = None
+    return list(packs)
+
+def main():
+    """
+    Program execution begins here.
+    """
 
-    # Write new version to resource pack
     try:
-        with open('./BP/manifest.json', 'r') as manifest_file:
-            manifest = json.load(manifest_file)
+        settings = json.loads(sys.argv[1])
+    except IndexError:
+        settings = {}
 
-        with open('./BP/manifest.json', 'w') as manifest_file:
-            json.dump(update_manifest(manifest, version), manifest_file, indent=4)
+    packs = find_packs(settings.get("packs", ["RP", "BP"]))
+    only_on_change = settings.get("only_on_change", False)
+    workers = settings.get("workers", os.cpu_count() or 1)
+    profiler = Profiler("bump_manifest", settings)
 
-    except FileNotFoundError:
-        pass
+    content_hash = None
+    if only_on_change:
+        profiler.phase("hash packs")
+        paths = list_pack_files(packs)
+        profiler.read(len(paths))
+        content_hash = hash_packs(paths, workers)
+
+    # Get current version, and update the file
+    profiler.phase("bump version")
+    version, bumped = get_version(content_hash)
+
+    if bumped:
+        print("Pack updated to version: ", str(version))
+    else:
+        print("Pack content unchanged, keeping version: ", str(version))
+
+    # Write new version to every pack. Packs without a manifest are skipped.
+    profiler.phase("write manifests")
+    with ThreadPoolExecutor() as executor:
+        bumped_packs = profiler.map(executor.map, lambda pack_path: bump_pack(pack_path, version), packs)
+    profiler.read(sum(bumped_packs))
+    profiler.written(sum(bumped_packs))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,11 +1,20 @@
+import os
 import json
 import sys
+import time
+import hashlib
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Type, Union
+from typing import Dict, List, NamedTuple, Optional, Tuple, Type, Union
+
+from profiler import Profiler
 
 REALITY_PATH = Path("")
 EXPECTATIONS_PATH = Path("data/filter_tester")
+INDEX_PATH = EXPECTATIONS_PATH / "index.json"
 
 def print_red(text):
     for t in text.split('\n'):
@@ -19,70 +28,372 @@ JSON = Union[Dict, List, str, int, float, bool, Type[None]]
 def json_path_to_str(json_path: List[Union[int, str]]) -> str:
     return f'[{"->".join(str(i) for i in json_path)}]'
 
+# A JSON path, stored as nested (parent, key) tuples so that the paths of all
+# children share the path of their parent instead of copying it. The root is
+# None.
+LinkedJsonPath = Optional[Tuple["LinkedJsonPath", Union[int, str]]]
+
+def linked_path_to_list(json_path: LinkedJsonPath) -> List[Union[int, str]]:
+    result = []
+    while json_path is not None:
+        json_path, key = json_path
+        result.append(key)
+    result.reverse()
+    return result
+
+class JsonMismatch(NamedTuple):
+    '''
+    A difference between two JSON objects.
+    '''
+    json_path: List[Union[int, str]]
+    message: str
+
+def diff_json(
+        reality: JSON, expectations: JSON,
+        max_mismatches: Optional[int]=None,
+        json_path: List[Union[int, str]]=None) -> List[JsonMismatch]:
+    '''
+    Compares the content of two JSON objects, and returns their differences,
+    stopping after max_mismatches of them (no limit if None).
+
+    The objects are walked with an explicit stack, so deeply nested JSON
+    doesn't hit the recursion limit. The keys of dictionaries are compared in
+    the order of the reality.
+    '''
+    root: LinkedJsonPath = None
+    for key in json_path or []:
+        root = (root, key)
+    mismatches: List[JsonMismatch] = []
+    stack = [(reality, expectations, root)]
+    while stack:
+        if max_mismatches is not None and len(mismatches) >= max_mismatches:
+            break
+        reality, expectations, path = stack.pop()
+        try:
+            if reality == expectations:
+                continue
+        except RecursionError:
+            pass  # Too deep to compare at once, walk it instead
+        if type(reality) != type(expectations):
+            full_path = linked_path_to_list(path)
+            mismatches.append(JsonMismatch(
+                full_path,
+                f"Type mismatch at {json_path_to_str(full_path)}: "
+                f"{reality} != {expectations}"))
+        elif isinstance(reality, dict):
+            surplus_keys = [k for k in reality if k not in expectations]
+            missing_keys = [k for k in expectations if k not in reality]
+            if surplus_keys or missing_keys:
+                full_path = linked_path_to_list(path)
+                error = [f"JSON keys mismatch at {json_path_to_str(full_path)}"]
+                if surplus_keys:
+                    error.append(f"    Unexpected keys: {', '.join(surplus_keys)}")
+                if missing_keys:
+                    error.append(f"    Missing keys: {', '.join(missing_keys)}")
+                mismatches.append(JsonMismatch(full_path, "\n".join(error)))
+            # Pushed in reverse, so that the keys are popped in order
+            stack.extend(
+                (reality[key], expectations[key], (path, key))
+                for key in reversed([k for k in reality if k in expectations]))
+        elif isinstance(reality, list):
+            if len(reality) != len(expectations):
+                full_path = linked_path_to_list(path)
+                mismatches.append(JsonMismatch(
+                    full_path,
+                    f"JSON list length mismatch at {json_path_to_str(full_path)}, "
+                    f"expected {len(expectations)} elements, got {len(reality)}"))
+                continue
+            stack.extend(
+                (reality[i], expectations[i], (path, i))
+                for i in reversed(range(len(reality))))
+        else:
+            full_path = linked_path_to_list(path)
+            mismatches.append(JsonMismatch(
+                full_path,
+                f"Value mismatch at {json_path_to_str(full_path)}: "
+                f"{reality} != {expectations}"))
+    return mismatches
+
 def assert_eq_json(
         reality: JSON, expectations: JSON, json_path: List[str]=None) -> None:
     '''
     Compares the content of two JSON objects. If they are not equal, an
     FilterTesterException is raised.
     '''
-    if json_path is None:
-        json_path = []
-    if reality == expectations:
-        return
-    elif type(reality) != type(expectations):
-        raise FilterTesterException(
-            f"Type mismatch at {json_path_to_str(json_path)}: "
-            f"{reality} != {expectations}")
-    elif isinstance(reality, dict):
-        assert_eq_dict(reality, expectations, json_path)
-    elif isinstance(reality, list):
-        assert_eq_list(reality, expectations, json_path)
-    elif reality != expectations:
+    mismatches = diff_json(reality, expectations, 1, json_path)
+    if mismatches:
+        raise FilterTesterException(mismatches[0].message)
+
+def file_hash(path: Path) -> str:
+    '''
+    Hashes the content of a file, reading it in chunks.
+    '''
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+def json_hash(data: JSON) -> str:
+    '''
+    Hashes the normalized content of a JSON object, so that JSON files with a
+    different formatting or key order have the same hash.
+    '''
+    normalized = json.dumps(
+        data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def index_file(file: Path) -> Tuple[str, dict]:
+    '''
+    Creates the index entry of a file of the reality.
+    '''
+    path = REALITY_PATH / file
+    if path.is_dir():
+        return file.as_posix(), {"dir": True}
+    entry = {"size": os.path.getsize(path), "hash": file_hash(path)}
+    if file.suffix == ".json":
+        try:
+            with open(path, "r") as f:
+                entry["json_hash"] = json_hash(json.load(f))
+        except Exception:
+            pass  # Not valid JSON, compared as a binary file
+    return file.as_posix(), entry
+
+def list_files(root: Path) -> set:
+    return set(chain(
+        [i.relative_to(root) for i in root.glob("RP/**/*")],
+        [i.relative_to(root) for i in root.glob("BP/**/*")]))
+
+class FileResult(NamedTuple):
+    '''
+    The result of comparing a file of the reality with the expectations.
+    '''
+    file: Path
+    passed: bool
+    mismatches: List[JsonMismatch]
+    # Whether more mismatches were found than reported
+    truncated: bool
+    seconds: float
+
+    def error(self) -> FilterTesterException:
+        message = f"File mismatch at {self.file.as_posix()}"
+        if self.mismatches:
+            message += ":" + "\n".join(m.message for m in self.mismatches)
+        if self.truncated:
+            message += f"\n    Stopped after {len(self.mismatches)} mismatches"
+        return FilterTesterException(message)
+
+def compare_file(file: Path, max_mismatches: Optional[int]) -> FileResult:
+    '''
+    Compares a file of the reality with the file of the expectations. The
+    sizes are compared first, then the hashes of the contents. JSON files
+    with different contents are compared structurally, as they may still be
+    equal with a different formatting.
+    '''
+    start = time.perf_counter()
+
+    def result(passed: bool, mismatches: List[JsonMismatch]=[]) -> FileResult:
+        truncated = max_mismatches is not None and len(mismatches) > max_mismatches
+        if truncated:
+            mismatches = mismatches[:max_mismatches]
+        return FileResult(
+            file, passed, mismatches, truncated, time.perf_counter() - start)
+
+    reality_path = REALITY_PATH / file
+    expectations_path = EXPECTATIONS_PATH / file
+    if reality_path.is_dir() ^ expectations_path.is_dir():
+        return result(False)
+    if reality_path.is_dir():
+        return result(True)  # Both are directories, so we don't need to compare them
+    if (
+            os.path.getsize(reality_path) == os.path.getsize(expectations_path)
+            and file_hash(reality_path) == file_hash(expectations_path)):
+        return result(True)
+    if file.suffix == ".json":  # JSON is a special case
+        try:
+            with open(reality_path, "r") as f:
+                reality = json.load(f)
+            with open(expectations_path, "r") as f:
+                expectations = json.load(f)
+        except Exception:  # Not valid JSON, so the files are different
+            return result(False)
+        # One more mismatch than reported is searched, to know if there are
+        # more of them
+        mismatches = diff_json(
+            reality, expectations,
+            None if max_mismatches is None else max_mismatches + 1)
+        return result(not mismatches, mismatches)
+    return result(False)
+
+def verify_file(
+        file: Path, entry: dict, max_mismatches: Optional[int]) -> FileResult:
+    '''
+    Compares a file of the reality with its entry in the index. Only the
+    reality is read, unless the file is a JSON file with a different content
+    and the expected file exists, in which case the files are compared
+    structurally, to report the differences. The differences are only
+    reported when the expected file still matches the index.
+    '''
+    start = time.perf_counter()
+
+    def result(passed: bool, mismatches: List[JsonMismatch]=[]) -> FileResult:
+        truncated = max_mismatches is not None and len(mismatches) > max_mismatches
+        if truncated:
+            mismatches = mismatches[:max_mismatches]
+        return FileResult(
+            file, passed, mismatches, truncated, time.perf_counter() - start)
+
+    reality_path = REALITY_PATH / file
+    if reality_path.is_dir() ^ entry.get("dir", False):
+        return result(False)
+    if reality_path.is_dir():
+        return result(True)
+    if (
+            os.path.getsize(reality_path) == entry["size"]
+            and file_hash(reality_path) == entry["hash"]):
+        return result(True)
+    if file.suffix != ".json" or "json_hash" not in entry:
+        return result(False)
+    try:
+        with open(reality_path, "r") as f:
+            reality = json.load(f)
+    except Exception:  # Not valid JSON, so the files are different
+        return result(False)
+    if json_hash(reality) == entry["json_hash"]:
+        return result(True)
+    # The expected file is only opened to find the differences
+    try:
+        with open(EXPECTATIONS_PATH / file, "r") as f:
+            expectations = json.load(f)
+    except Exception:
+        return result(False)
+    if json_hash(expectations) != entry["json_hash"]:
+        # The differences with a file which wasn't recorded would be wrong
+        return result(False, [JsonMismatch(
+            [],
+            f"The expected file is out of sync with {INDEX_PATH.as_posix()}, "
+            f"record the expectations again to see the differences")])
+    mismatches = diff_json(
+        reality, expectations,
+        None if max_mismatches is None else max_mismatches + 1)
+    return result(False, mismatches)
+
+def record(workers: int, profiler: Profiler) -> None:
+    '''
+    Writes the index of the files of the reality, with their sizes and
+    hashes, to be used as the expectations of the 'verify' mode.
+    '''
+    profiler.phase("list files")
+    files = sorted(list_files(REALITY_PATH))
+    profiler.phase("index files")
+    if workers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            entries = dict(profiler.map(executor.map, index_file, files))
+    else:
+        entries = dict(profiler.map(map, index_file, files))
+    profiler.read(len(files))
+    profiler.phase("write index")
+    profiler.written()
+    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(INDEX_PATH, "w") as f:
+        json.dump({"files": entries}, f, indent=4)
+    print(f"Recorded {len(entries)} files to {INDEX_PATH.as_posix()}")
+
+def read_index() -> Dict[str, dict]:
+    '''
+    Reads the index written by the 'record' mode.
+    '''
+    try:
+        with open(INDEX_PATH, "r") as f:
+            return json.load(f)["files"]
+    except FileNotFoundError:
         raise FilterTesterException(
-            f"Value mismatch at {json_path_to_str(json_path)}: "
-            f"{reality} != {expectations}")
-
-def assert_eq_dict(
-        reality: Dict, expectations: Dict, json_path: List[str]) -> None:
-    '''
-    Asserts that two JSON dictionaries are equal.
-    '''
-    reality_keys = set(reality.keys())
-    expectations_keys = set(expectations.keys())
-    if reality_keys != expectations_keys:
-        surplus_keys = reality_keys - expectations_keys
-        missing_keys = expectations_keys - reality_keys
-        error = [f"JSON keys mismatch at {json_path_to_str(json_path)}"]
-        if surplus_keys:
-            error.append(f"    Unexpected keys: {', '.join(surplus_keys)}")
-        if missing_keys:
-            error.append(f"    Missing keys: {', '.join(missing_keys)}")
-        raise FilterTesterException("\n".join(error))
-    for key in reality_keys:
-        assert_eq_json(reality[key], expectations[key], json_path + [key])
-
-def assert_eq_list(
-        reality: List, expectations: List, json_path: List[str]) -> None:
-    '''
-    Asserts that two JSON lists are equal.
-    '''
-    if len(reality) != len(expectations):
+            f"Missing {INDEX_PATH.as_posix()}, run the 'record' mode first")
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
         raise FilterTesterException(
-            f"JSON list length mismatch at {json_path_to_str(json_path)}, "
-            f"expected {len(expectations)} elements, got {len(reality)}")
-    for i in range(len(reality)):
-        assert_eq_json(reality[i], expectations[i], json_path + [i])
-
-def main(errors_stop_execution: bool):
-    reality_files = set(chain(
-        [i.relative_to(REALITY_PATH) for i in REALITY_PATH.glob("RP/**/*")],
-        [i.relative_to(REALITY_PATH) for i in REALITY_PATH.glob("BP/**/*")]))
-    expectations_files = set(chain(
-        [i.relative_to(EXPECTATIONS_PATH) for i in EXPECTATIONS_PATH.glob("RP/**/*")],
-        [i.relative_to(EXPECTATIONS_PATH) for i in EXPECTATIONS_PATH.glob("BP/**/*")])
-    )
+            f"Invalid {INDEX_PATH.as_posix()}, run the 'record' mode again: {e}")
+
+def write_report(
+        path: Path, results: List[FileResult],
+        files_error: Optional[FilterTesterException], seconds: float) -> None:
+    '''
+    Writes a report of the comparison. Reports with the '.xml' extension use
+    the JUnit XML format, all other reports are written as JSON.
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    failures = sum(not r.passed for r in results) + (files_error is not None)
+    if path.suffix == ".xml":
+        suite = ET.Element(
+            "testsuite", name="filter_tester",
+            tests=str(len(results) + 1), failures=str(failures),
+            time=f"{seconds:.6f}")
+        case = ET.SubElement(
+            suite, "testcase", classname="filter_tester", name="Files")
+        if files_error is not None:
+            ET.SubElement(
+                case, "failure", message=str(files_error).splitlines()[0].rstrip(":")
+            ).text = str(files_error)
+        for r in results:
+            case = ET.SubElement(
+                suite, "testcase", classname="filter_tester",
+                name=r.file.as_posix(), time=f"{r.seconds:.6f}")
+            if not r.passed:
+                ET.SubElement(
+                    case, "failure", message=f"File mismatch at {r.file.as_posix()}"
+                ).text = str(r.error())
+        ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+        return
+    report = {
+        "passed": failures == 0,
+        "seconds": seconds,
+        "files_error": None if files_error is None else str(files_error),
+        "files": [
+            {
+                "path": r.file.as_posix(),
+                "passed": r.passed,
+                "seconds": r.seconds,
+                "mismatches": [
+                    {"json_path": m.json_path, "message": m.message}
+                    for m in r.mismatches
+                ],
+                "truncated": r.truncated,
+            }
+            for r in results
+        ],
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+
+def main(
+        errors_stop_execution: bool, workers: int,
+        max_mismatches: Optional[int]=None, report: Optional[str]=None,
+        mode: str="compare", profiler: Optional[Profiler]=None):
+    if profiler is None:
+        profiler = Profiler("filter_tester", {})
+    if mode == "record":
+        record(workers, profiler)
+        return
+    if mode not in ("compare", "verify"):
+        raise ValueError(
+            f"Unknown mode '{mode}', expected 'compare', 'record' or 'verify'")
+    start = time.perf_counter()
+    profiler.phase("list files")
+    reality_files = list_files(REALITY_PATH)
     errors = []
-    if expectations_files != reality_files:
+    files_error = None
+    if mode == "verify":
+        # The expectations are read from the index instead of the files
+        try:
+            index = read_index()
+            expectations_files = {Path(i) for i in index}
+        except FilterTesterException as e:
+            # Nothing can be verified without the index
+            files_error = e
+            errors.append(files_error)
+            expectations_files = set()
+    else:
+        expectations_files = list_files(EXPECTATIONS_PATH)
+    if files_error is None and expectations_files != reality_files:
         surplus_files = reality_files - expectations_files
         missing_files = expectations_files - reality_files
         error = [f"Files mismatch:"]
@@ -94,39 +405,35 @@ def main(errors_stop_execution: bool):
             error.append(
                 f"    Missing files: "
                 f"{', '.join(i.as_posix() for i in missing_files)}")
-        errors.append(FilterTesterException("\n".join(error)))
-    common_files = expectations_files & reality_files
-
-    def compare_binary_files(file: Path) -> None:
-        with open(REALITY_PATH / file, "rb") as f:
-            reality = f.read()
-        with open(EXPECTATIONS_PATH / file, "rb") as f:
-            expectations = f.read()
-        if reality != expectations:
-            errors.append(FilterTesterException(
-                f"File mismatch at {file.as_posix()}"))
-
-    for file in common_files:
-        if (REALITY_PATH / file).is_dir() ^ (EXPECTATIONS_PATH / file).is_dir():
-            errors.append(FilterTesterException(
-                f"File mismatch at {file.as_posix()}"))
-        if (REALITY_PATH / file).is_dir():
-            continue  # Both are directories, so we don't need to compare them
-        if file.suffix == ".json":  # JSON is a special case
-            try:
-                with open(REALITY_PATH / file, "r") as f:
-                    reality = json.load(f)
-                with open(EXPECTATIONS_PATH / file, "r") as f:
-                    expectations = json.load(f)
-                try:
-                    assert_eq_json(reality, expectations)
-                except FilterTesterException as e:
-                    errors.append(FilterTesterException(
-                        f"File mismatch at {file.as_posix()}:" + str(e)))
-            except Exception as e:  # Compare files like binary files
-                compare_binary_files(file)
-        else:
-            compare_binary_files(file)
+        files_error = FilterTesterException("\n".join(error))
+        errors.append(files_error)
+    # Sorted, so that the errors are always printed in the same order
+    common_files = sorted(expectations_files & reality_files)
+
+    profiler.phase(f"{mode} files")
+    if mode == "verify":
+        compare = lambda file: verify_file(
+            file, index[file.as_posix()], max_mismatches)
+        profiler.read(len(common_files) + 1)
+    else:
+        compare = partial(compare_file, max_mismatches=max_mismatches)
+        # The reality and the expectations are both read
+        profiler.read(len(common_files) * 2)
+    if workers > 1 and len(common_files) > 1:
+        # Hashing releases the GIL, so the files are compared in threads
+        with ThreadPoolExecutor(workers) as executor:
+            results = profiler.map(executor.map, compare, common_files)
+    else:
+        results = profiler.map(map, compare, common_files)
+    errors.extend(r.error() for r in results if not r.passed)
+
+    if report is not None:
+        profiler.phase("write report")
+        profiler.written()
+        write_report(
+            EXPECTATIONS_PATH / report, results, files_error,
+            time.perf_counter() - start)
+
     if errors:
         for error in errors:
             print_red(str(error))
@@ -139,4 +446,9 @@ if __name__ == "__main__":
     except Exception:
         config = {}
     errors_stop_execution = config.get("errors_stop_execution", False)
-    main(errors_stop_execution)
+    workers = config.get("workers", os.cpu_count() or 1)
+    max_mismatches = config.get("max_mismatches", 10)
+    report = config.get("report")
+    mode = config.get("mode", "compare")
+    profiler = Profiler("filter_tester", config)
+    main(errors_stop_execution, workers, max_mismatches, report, mode, profiler)
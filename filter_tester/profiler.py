@@ -0,0 +1,237 @@
+"""
+Opt-in profiling of the filters. Reports the wall time of every phase of a
+filter, its slowest files, and the number of files it read and wrote.
+Optionally, the filter is also profiled with cProfile and tracemalloc.
+
+Profiling is enabled with the 'profiling' setting of a filter, or for every
+filter of a run with the REGOLITH_FILTER_PROFILING environment variable. The
+report is printed when the filter exits, and saved with the optional dumps
+to data/<filter>/profiling, which is exported back to the project with the
+data folder of the filter.
+
+Filters are installed individually, so an identical copy of this module is
+shipped with every filter that uses it.
+"""
+
+import os
+import json
+import time
+import atexit
+import heapq
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+ENVIRONMENT_VARIABLE = "REGOLITH_FILTER_PROFILING"
+DATA_PATH = Path("data")
+DEFAULT_OPTIONS = {"slowest": 10, "cprofile": False, "tracemalloc": False}
+
+
+def read_options(settings: dict) -> Optional[dict]:
+    """
+    Returns the profiling options, or None when profiling is disabled.
+
+    The 'profiling' setting is either a boolean or an object with the
+    options. The environment variable is used when the setting is not set.
+    It's a comma separated list, which enables profiling with any value
+    other than '0' or 'false', e.g. '1' or 'cprofile,tracemalloc,slowest=20'.
+    A 'slowest' option without a valid number is ignored.
+    """
+    value = settings.get("profiling")
+    if value is None:
+        environment = os.environ.get(ENVIRONMENT_VARIABLE, "").strip()
+        if environment.lower() in ("", "0", "false"):
+            return None
+        value = {}
+        for option in environment.split(","):
+            name, _, option_value = option.strip().lower().partition("=")
+            if name in ("cprofile", "tracemalloc"):
+                value[name] = True
+            elif name == "slowest":
+                try:
+                    value[name] = int(option_value)
+                except ValueError:
+                    print(
+                        f"Warning: ignoring '{option.strip()}' in {ENVIRONMENT_VARIABLE}, "
+                        f"expected 'slowest=<number of files>'")
+    if value is False:
+        return None
+    if value is True:
+        value = {}
+    if not isinstance(value, dict):
+        raise ValueError("The 'profiling' setting must be a boolean or an object.")
+    return {**DEFAULT_OPTIONS, **value}
+
+
+def file_path(item: Any) -> str:
+    """
+    The default name of the files in the reports.
+    """
+    if isinstance(item, (str, os.PathLike)):
+        return Path(item).as_posix()
+    return str(item)
+
+
+class Timed:
+    """
+    Wraps a function, so that it returns its result together with the time it
+    took. It can be pickled, for process pools, when the function can.
+    """
+    def __init__(self, function: Callable) -> None:
+        self.function = function
+
+    def __call__(self, *args, **kwargs) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        result = self.function(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+class Profiler:
+    """
+    Collects the profile of a filter. When profiling is disabled, every
+    method does nothing, so the filters can use it unconditionally.
+
+    The phases follow each other: starting a phase ends the previous one.
+    """
+    def __init__(self, name: str, settings: dict) -> None:
+        self.name = name
+        self.options = read_options(settings)
+        self.enabled = self.options is not None
+        self.phases = {}
+        self.files_timed: List[Tuple[float, str]] = []
+        self.files_read = 0
+        self.files_written = 0
+        self.current_phase = None
+        self.finished = False
+        self.cprofile = None
+        if not self.enabled:
+            return
+
+        self.path = DATA_PATH / name / "profiling"
+        if self.options["tracemalloc"]:
+            import tracemalloc
+            tracemalloc.start()
+        if self.options["cprofile"]:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.start = self.phase_start = time.perf_counter()
+        # Called on exit, so that the filters which exit with an error are
+        # reported as well
+        atexit.register(self.finish)
+
+    def phase(self, name: str) -> None:
+        """
+        Ends the current phase, and starts a new one. The time of phases with
+        the same name is added up.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self._end_phase(now)
+        self.current_phase = name
+        self.phase_start = now
+
+    def _end_phase(self, now: float) -> None:
+        if self.current_phase is not None:
+            self.phases[self.current_phase] = (
+                self.phases.get(self.current_phase, 0.0) + now - self.phase_start)
+            self.current_phase = None
+
+    def file(self, item: Any, seconds: float) -> None:
+        """
+        Records the time spent on a single file.
+        """
+        if self.enabled:
+            self.files_timed.append((seconds, file_path(item)))
+
+    def files(self, items: Iterable, path: Callable[[Any], str] = file_path) -> Iterator:
+        """
+        Yields the items, and records the time spent on every item by the
+        loop which iterates them.
+        """
+        if not self.enabled:
+            yield from items
+            return
+        for item in items:
+            start = time.perf_counter()
+            yield item
+            self.file(path(item), time.perf_counter() - start)
+
+    def map(
+            self, map_function: Callable, function: Callable, items: Iterable,
+            path: Callable[[Any], str] = file_path, **kwargs) -> list:
+        """
+        Returns map_function(function, items, **kwargs) as a list, and
+        records the time spent on every item. The map function is the builtin
+        map, or the map of an executor, in which case the function is timed
+        in the workers.
+        """
+        if not self.enabled:
+            return list(map_function(function, items, **kwargs))
+        items = list(items)
+        results = []
+        for item, (result, seconds) in zip(items, map_function(Timed(function), items, **kwargs)):
+            self.file(path(item), seconds)
+            results.append(result)
+        return results
+
+    def read(self, count: int = 1) -> None:
+        self.files_read += count
+
+    def written(self, count: int = 1) -> None:
+        self.files_written += count
+
+    def report(self) -> dict:
+        slowest = heapq.nlargest(self.options["slowest"], self.files_timed)
+        return {
+            "filter": self.name,
+            "seconds": self.seconds,
+            "phases": self.phases,
+            "files_read": self.files_read,
+            "files_written": self.files_written,
+            "files_timed": len(self.files_timed),
+            "slowest": [{"path": path, "seconds": seconds} for seconds, path in slowest],
+        }
+
+    def finish(self) -> None:
+        """
+        Ends the profiling, prints the report and saves it with the dumps.
+        Only the first call does anything.
+        """
+        if not self.enabled or self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        self._end_phase(now)
+        self.seconds = now - self.start
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+        report = self.report()
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self.options["tracemalloc"]:
+            import tracemalloc
+            report["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            statistics = tracemalloc.take_snapshot().statistics("lineno")
+            tracemalloc.stop()
+            with open(self.path / "tracemalloc.txt", "w") as f:
+                f.write(f"Peak: {report['peak_memory'] / 1024 / 1024:.1f} MiB\n")
+                for statistic in statistics[:50]:
+                    f.write(f"{statistic}\n")
+        if self.cprofile is not None:
+            # Readable with pstats, or tools like snakeviz
+            self.cprofile.dump_stats(self.path / "cprofile.prof")
+        with open(self.path / "report.json", "w") as f:
+            json.dump(report, f, indent=4)
+
+        print(f"Profiling of {self.name}: {self.seconds:.3f} s")
+        for name, seconds in self.phases.items():
+            print(f"    {name}: {seconds:.3f} s")
+        print(f"    Files read: {self.files_read}, written: {self.files_written}")
+        if report["slowest"]:
+            print("    Slowest files:")
+            for file in report["slowest"]:
+                print(f"        {file['seconds']:.3f} s {file['path']}")
+        if "peak_memory" in report:
+            print(f"    Peak memory: {report['peak_memory'] / 1024 / 1024:.1f} MiB")
+        print(f"    Saved to {self.path.as_posix()}")
@@ -1,19 +1,229 @@
-import glob
+import io
+import os
+import sys
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-from PIL import Image
+from PIL import Image, ImageChops
 
+from file_index import FileIndex
+from profiler import Profiler
+
+TEXTURES_PATH = Path("RP/textures")
+CACHE_PATH = Path("data/fix_emissive")
+CACHE_INDEX_PATH = CACHE_PATH / "cache.json"
+CACHE_TEXTURES_PATH = CACHE_PATH / "textures"
+
+# The cache index of the previous run, set for every worker process. None when
+# caching is disabled.
+_cache = None
+
+
+def transparent_mask(alpha):
+    """
+    Returns an 'L' mask which is 255 wherever the alpha channel is 0, and 0
+    everywhere else.
+    """
+    return alpha.point(lambda a: 255 if a == 0 else 0)
 
-def fix(input_img, output_img):
-    img = Image.open(input_img)
-    pixels = img.load()
 
-    for i in range(img.size[0]):
-        for j in range(img.size[1]):
-            if pixels[i, j][3] == 0:
-                pixels[i, j] = (0, 0, 0, 0)
+def clear_transparent(img) -> bool:
+    """
+    Removes the color data from all fully transparent pixels of the image, in
+    place. Images without transparency are left untouched.
 
+    Returns whether the image was modified.
+    """
+    if img.mode in ("RGBA", "LA"):
+        alpha = img.getchannel("A")
+        # No fully transparent pixels, nothing to clear
+        if alpha.getextrema()[0] != 0:
+            return False
+        mask = transparent_mask(alpha)
+        # The image is already clean, if all color bands are 0 under the mask
+        if all(
+                ImageChops.darker(img.getchannel(band), mask).getbbox() is None
+                for band in img.getbands() if band != "A"):
+            return False
+        img.paste((0,) * len(img.getbands()), mask=mask)
+        return True
+    elif img.mode == "P" and "transparency" in img.info:
+        # Clear the palette entries of the fully transparent indices
+        transparency = img.info["transparency"]
+        if isinstance(transparency, int):
+            transparent = [transparency]
+        else:
+            transparent = [index for index, a in enumerate(transparency) if a == 0]
+        palette = img.getpalette()
+        modified = False
+        for index in transparent:
+            if any(palette[index * 3:index * 3 + 3]):
+                palette[index * 3:index * 3 + 3] = [0, 0, 0]
+                modified = True
+        if modified:
+            img.putpalette(palette)
+        return modified
+    return False
+
+
+def fix(input_img, output_img) -> bool:
+    """
+    Fixes the input image and saves it to the output path. Nothing is written
+    when the image is already clean.
+
+    Returns whether the image was modified.
+    """
+    img = Image.open(input_img)
+    img.load()
+    if not clear_transparent(img):
+        return False
     img.save(output_img)
+    return True
+
+
+def load_cache() -> dict:
+    """
+    Loads the cache index, which maps the content hash of an input texture to
+    the content hash of the fixed texture.
+    """
+    try:
+        with open(CACHE_INDEX_PATH, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(cache: dict) -> None:
+    """
+    Saves the cache index, and removes the cached textures which are no longer
+    referenced by it.
+    """
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_INDEX_PATH, 'w') as f:
+        json.dump(cache, f, indent=4)
+
+    if CACHE_TEXTURES_PATH.exists():
+        referenced = set(cache.values())
+        for cached_texture in CACHE_TEXTURES_PATH.iterdir():
+            if cached_texture.stem not in referenced:
+                cached_texture.unlink()
+
+
+def fix_cached(texture: Path, cache: dict):
+    """
+    Fixes the texture in place, reusing the result of a previous run when the
+    content of the texture didn't change.
+
+    Returns the content hashes of the input and of the fixed texture.
+    """
+    data = texture.read_bytes()
+    input_hash = hashlib.sha256(data).hexdigest()
+
+    output_hash = cache.get(input_hash)
+    if output_hash == input_hash:
+        return input_hash, output_hash
+    if output_hash is not None:
+        cached_texture = CACHE_TEXTURES_PATH / f"{output_hash}.png"
+        if cached_texture.exists():
+            shutil.copyfile(cached_texture, texture)
+            return input_hash, output_hash
+
+    if not fix(io.BytesIO(data), texture):
+        return input_hash, input_hash
+    output_hash = hashlib.sha256(texture.read_bytes()).hexdigest()
+    if output_hash != input_hash:
+        # Copy through a temporary file, as other workers may be caching a
+        # texture with the same content
+        CACHE_TEXTURES_PATH.mkdir(parents=True, exist_ok=True)
+        temp_path = CACHE_TEXTURES_PATH / f"{output_hash}.{os.getpid()}.tmp"
+        shutil.copyfile(texture, temp_path)
+        os.replace(temp_path, CACHE_TEXTURES_PATH / f"{output_hash}.png")
+    return input_hash, output_hash
+
+
+def init_worker(cache) -> None:
+    global _cache
+    _cache = cache
+
+
+def process_texture(texture: Path):
+    """
+    Fixes a single texture. Errors are returned instead of raised, so that a
+    single broken texture doesn't stop the other ones from being processed.
+
+    Returns a tuple of (texture, input_hash, output_hash, modified, error).
+    """
+    try:
+        if _cache is None:
+            return texture, None, None, fix(texture, texture), None
+        input_hash, output_hash = fix_cached(texture, _cache)
+        return texture, input_hash, output_hash, input_hash != output_hash, None
+    except Exception as e:
+        return texture, None, None, False, f"{type(e).__name__}: {e}"
+
+
+def main():
+    try:
+        settings = json.loads(sys.argv[1])
+    except IndexError:
+        settings = {}
+
+    use_cache = settings.get("cache", True)
+    workers = settings.get("workers", os.cpu_count() or 1)
+    profiler = Profiler("fix_emissive", settings)
+
+    profiler.phase("list textures")
+    index = FileIndex("fix_emissive")
+    textures = [Path(entry.path) for entry in index.files(TEXTURES_PATH, [".png"])]
+    index.save()
+
+    profiler.phase("fix textures")
+    cache = load_cache() if use_cache else None
+
+    if workers > 1 and len(textures) > 1:
+        # Send the textures in chunks, so that small textures don't spend more
+        # time in inter-process communication than in processing
+        chunk_size = max(1, len(textures) // (workers * 4))
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(cache,)) as executor:
+            results = profiler.map(executor.map, process_texture, textures, chunksize=chunk_size)
+    else:
+        init_worker(cache)
+        results = profiler.map(map, process_texture, textures)
+
+    errors = []
+    modified_count = 0
+    # Only the textures seen in this run are kept in the cache
+    new_cache = {}
+    for texture, input_hash, output_hash, modified, error in results:
+        if error is not None:
+            errors.append(f"{texture.as_posix()}: {error}")
+            continue
+        if modified:
+            modified_count += 1
+        if use_cache:
+            new_cache[input_hash] = output_hash
+            # The fixed texture doesn't need fixing again
+            new_cache[output_hash] = output_hash
+
+    profiler.read(len(textures))
+    profiler.written(modified_count)
+
+    if use_cache:
+        profiler.phase("save cache")
+        save_cache(new_cache)
+
+    untouched_count = len(results) - modified_count - len(errors)
+    print(f"Fixed {modified_count} texture(s), {untouched_count} texture(s) were already clean.")
+
+    if errors:
+        print(f"Failed to fix {len(errors)} texture(s):")
+        for error in errors:
+            print(f"    {error}")
+        sys.exit(1)
 
 
-for texture in glob.glob("./RP/textures/**/*.png", recursive=True):
-    fix(texture, texture)
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,23 @@ based on a custom 'name' field, or automatically generated based on the entities
 identifier. See 'readme.md' for more information.
 """
 
+import io
+import re
+import os
 import sys
+import glob
 import json
-from typing import List, NamedTuple
+import shutil
+import hashlib
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from enum import Enum
 
 from reticulator import *
 
+from profiler import Profiler
+
 class AssetType(Enum):
     SPAWN_EGG = 1
     ITEM = 2
@@ -28,6 +38,286 @@ class NameJsonPath(NamedTuple):
     should_pop: bool = False
     add_affixes: bool = False
 
+class NameSource(NamedTuple):
+    """Describes an asset type to gather translations for, when walking a
+    collection of assets.
+
+    asset_type: the type of the generated translations
+    settings: the settings of the asset type (auto_name, prefix, postfix)
+    name_jsonpaths: the jsonpath candidates to read the name from, in order
+    """
+    asset_type: AssetType
+    settings: dict
+    name_jsonpaths: List[NameJsonPath]
+
+MANIFEST_PATH = os.path.join("data", "name_ninja", "manifest.json")
+MANIFEST_ASSETS_PATH = os.path.join("data", "name_ninja", "assets")
+
+# The regex used by reticulator to read the lines of a language file
+TRANSLATION_REGEX = re.compile("^([^#\n]+?)=([^#]+)#*?([^#]*?)$")
+
+def load_json(filepath: str) -> dict:
+    """
+    Loads a JSON file, the same way as reticulator does. Files with comments
+    are cleaned before parsing, and files which still can't be parsed are
+    loaded as an empty dict.
+    """
+    try:
+        with open(filepath, "r", encoding='utf8') as fh:
+            try:
+                return json.load(fh)
+            except json.JSONDecodeError:
+                try:
+                    fh.seek(0)
+                    contents = ""
+                    for line in fh.readlines():
+                        cleaned_line = line.split("//", 1)[0]
+                        if len(cleaned_line) > 0 and line.endswith("\n") and "\n" not in cleaned_line:
+                            cleaned_line += "\n"
+                        contents += cleaned_line
+                    while "/*" in contents:
+                        pre_comment, post_comment = contents.split("/*", 1)
+                        contents = pre_comment + post_comment.split("*/", 1)[1]
+                    return json.loads(contents)
+                except json.JSONDecodeError:
+                    return {}
+    except Exception:
+        raise InvalidJsonError(filepath)
+
+class FastAsset:
+    """
+    A lightweight stand-in for the reticulator assets, used by the fast mode.
+    It only implements what is needed to gather translations, and only parses
+    the file when its data is first accessed.
+    """
+    def __init__(self, pack_path: str, filepath: str, identifier_path: str) -> None:
+        self.pack_path = pack_path
+        self.filepath = filepath
+        self.identifier_path = identifier_path
+        self.modified = False
+
+    @cached_property
+    def data(self) -> dict:
+        return load_json(os.path.join(self.pack_path, self.filepath))
+
+    @property
+    def identifier(self) -> str:
+        return self.get_jsonpath(self.identifier_path)
+
+    @property
+    def format_version(self) -> FormatVersion:
+        return FormatVersion(self.get_jsonpath("format_version"))
+
+    def _resolve_jsonpath(self, json_path: str) -> Tuple[dict, str]:
+        """
+        Returns the dict which contains the value at the jsonpath, and the key
+        of the value.
+
+        raises:
+            AssetNotFoundError if the path does not exist.
+        """
+        parent = None
+        node = self.data
+        for key in json_path.split("/"):
+            if not isinstance(node, dict) or key not in node:
+                raise AssetNotFoundError(f"Path {json_path} does not exist.")
+            parent, node = node, node[key]
+        return parent, key
+
+    def get_jsonpath(self, json_path: str):
+        parent, key = self._resolve_jsonpath(json_path)
+        return parent[key]
+
+    def pop_jsonpath(self, json_path: str):
+        parent, key = self._resolve_jsonpath(json_path)
+        self.modified = True
+        return parent.pop(key)
+
+    def dumps(self) -> str:
+        """
+        Returns the content of the asset, the same way as reticulator saves it.
+        """
+        clean_data = {k: v for k, v in self.data.items() if v is not None}
+        return json.dumps(clean_data, indent=2, ensure_ascii=False)
+
+    def save(self) -> None:
+        with open(os.path.join(self.pack_path, self.filepath), "w+") as file_head:
+            file_head.write(self.dumps())
+
+def load_fast_assets(pack_path: str, folder: str, identifier_path: str) -> List[FastAsset]:
+    """
+    Lists the assets of a behavior pack folder, in the same order as
+    reticulator does.
+    """
+    base_directory = os.path.join(pack_path, folder)
+    return [
+        FastAsset(pack_path, os.path.relpath(local_path, pack_path), identifier_path)
+        for local_path in glob.glob(base_directory + "/**/*.json", recursive=True)
+    ]
+
+def asset_path(asset: JsonFileResource) -> str:
+    """
+    The name of an asset in the profile, relative to its pack.
+    """
+    return asset.filepath
+
+def read_translations(lines: List[str]) -> List[Translation]:
+    """
+    Reads the translations from the lines of a language file, the same way as
+    reticulator does. Comments and empty lines are dropped.
+    """
+    translations = []
+    for line in lines:
+        if match := TRANSLATION_REGEX.search(line):
+            key, value, comment = match.groups()
+            translations.append(Translation(key.strip(), value.strip(), comment.strip()))
+    return translations
+
+def format_translations(translations: List[Translation]) -> str:
+    """
+    Formats translations as the lines of a language file, the same way as
+    reticulator does.
+    """
+    return "".join(
+        f"{translation.key}={translation.value}\t##{translation.comment}\n"
+        for translation in translations)
+
+def native_newlines(text: str) -> str:
+    """
+    Returns the text with the line endings of files written in text mode, the
+    same way as reticulator writes language files.
+    """
+    return text.replace("\n", os.linesep)
+
+def index_translations(translations: List[Translation]) -> Dict[str, List[int]]:
+    """
+    Maps every key to the positions of its translations, in order.
+    """
+    index = {}
+    for position, translation in enumerate(translations):
+        index.setdefault(translation.key, []).append(position)
+    return index
+
+def merge_translations(translations: List[Translation], new_translations: List[Translation], overwrite: bool, new_index: Dict[str, List[int]] = None) -> Tuple[List[Translation], int]:
+    """
+    Merges new translations into the translations of a language file. The
+    result is the same as adding the new translations one by one with
+    LanguageFile.add_translation, but the whole batch is merged against an
+    index of the language file in a single pass.
+
+    The index of the new translations may be passed in, so that it's only
+    built once when the same batch is merged into many language files.
+
+    Returns the merged translations, and the number of added translations.
+    """
+    if new_index is None:
+        new_index = index_translations(new_translations)
+    index = index_translations(translations)
+
+    removed = set()
+    added = []
+    for key, new_positions in new_index.items():
+        positions = index.get(key, [])
+        if overwrite:
+            # add_translation replaces the oldest translation of the key, and
+            # appends the new one. Only the newest ones are left in the end.
+            removed.update(positions[:len(new_positions)])
+            added.extend(new_positions[-max(len(positions), 1):])
+        elif not positions:
+            # Without overwrite, only the first new translation is added
+            added.append(new_positions[0])
+    added.sort()
+
+    merged = [t for position, t in enumerate(translations) if position not in removed]
+    merged.extend(new_translations[position] for position in added)
+    return merged, len(added)
+
+def update_language_file(filepath: str, new_translations: List[Translation], new_index: Dict[str, List[int]], overwrite: bool, sort: bool, atomic: bool = False) -> bool:
+    """
+    Adds the translations to a language file. The file is left untouched if
+    no translation was added. When the existing translations are unchanged,
+    the new translations are appended to the end of the file instead of
+    rewriting it, unless the file must be written atomically.
+
+    Returns whether the file was written.
+    """
+    # Read without translating the line endings, so that a file with other
+    # line endings than reticulator writes is never appended to
+    with open(filepath, "r", encoding='utf-8', newline='') as language_file:
+        content = language_file.read()
+    # The lines as reticulator reads them, with universal newlines
+    lines = io.StringIO(content, newline=None).readlines()
+    translations = read_translations(lines)
+    merged, added_count = merge_translations(translations, new_translations, overwrite, new_index)
+
+    # Same as reticulator, the file is only saved if something was added
+    if added_count == 0:
+        return False
+    if sort:
+        merged.sort(key=lambda t: t.key)
+    # Overwriting translations with the same values doesn't change the file.
+    # The raw content is compared, so that a file with other line endings is
+    # still rewritten the way reticulator would.
+    if content == native_newlines(format_translations(merged)):
+        return False
+
+    unchanged_count = len(translations)
+    append = (
+        len(merged) == unchanged_count + added_count and
+        all(a is b for a, b in zip(merged, translations)) and
+        content == native_newlines(format_translations(translations)))
+    if append and not atomic:
+        with open(filepath, "a", encoding='utf-8') as language_file:
+            language_file.write(format_translations(merged[unchanged_count:]))
+        return True
+
+    # Rewritten through a temporary file, so that the language file is never
+    # left half written. Written in text mode, with the same line endings as
+    # reticulator, even when only new translations were appended.
+    temp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding='utf-8') as language_file:
+        language_file.write(format_translations(merged))
+    os.replace(temp_path, filepath)
+    return True
+
+def create_language_file(language: str) -> str:
+    """
+    Returns the path of the language file, creating an empty one if it doesn't
+    exist yet.
+    """
+    filepath = os.path.join("./RP", "texts", language)
+    if not os.path.isfile(filepath):
+        print(f"Warning: {language} file not found, creating...")
+        Path(os.path.dirname(filepath)).mkdir(parents=True, exist_ok=True)
+        open(filepath, 'a').close()
+    return filepath
+
+def update_language_files(languages: List[str], new_translations: List[Translation], new_index: Dict[str, List[int]], overwrite: bool, sort: bool, workers: int) -> int:
+    """
+    Adds the translations to every language file. With more than one worker,
+    the files are updated concurrently in a process pool, and every file is
+    written atomically, instead of appending to it.
+
+    Returns the number of files written.
+    """
+    # Missing files are created up front, so that the warnings are printed in
+    # the order of the settings. Duplicated languages are updated only once,
+    # to avoid two workers writing the same file.
+    filepaths = [create_language_file(language) for language in dict.fromkeys(languages)]
+
+    if workers <= 1 or len(filepaths) <= 1:
+        return sum(
+            update_language_file(filepath, new_translations, new_index, overwrite, sort, workers > 1)
+            for filepath in filepaths)
+
+    with ProcessPoolExecutor(min(workers, len(filepaths))) as executor:
+        futures = [
+            executor.submit(update_language_file, filepath, new_translations, new_index, overwrite, sort, True)
+            for filepath in filepaths
+        ]
+        # Errors are raised in the order of the languages
+        return sum(future.result() for future in futures)
+
 def generate_localization_key(asset_type: AssetType, asset: JsonResource):
     """
     Generates the localization key for the asset type. May depend on format version,
@@ -61,15 +351,79 @@ def format_name(name: str):
     """
     return name.split(":")[1].replace("_", " ").title()
 
-def gather_translations(asset_type: str, assets: List[JsonFileResource], settings: dict, name_jsonpaths: List[NameJsonPath], ignored_namespaces) -> List[Translation]:
+def gather_translation(asset_type: AssetType, asset: JsonFileResource, identifier: str, settings: dict, name_jsonpaths: List[NameJsonPath]) -> Optional[Translation]:
     """
-    Gathers translations from the behavior pack.
+    Gathers the translation of a single asset. Returns None if no name could
+    be resolved for it.
     """
     auto_name = settings.get('auto_name', False)
     prefix = settings.get('prefix', '')
     postfix = settings.get('postfix', '')
 
-    translations : List[Translation] = []
+    localization_key = generate_localization_key(asset_type, asset)
+
+    # Allow for generate_localization_key to return None (skip)
+    if localization_key is None:
+        return None
+
+    # Try loading localization_value from JSON paths
+    localization_value = None
+    for jp in name_jsonpaths:
+        path = jp.path
+        should_pop = jp.should_pop
+
+        try:
+            # Pop the value if requested
+            if should_pop:
+                localization_value = asset.pop_jsonpath(path)
+            else:
+                localization_value = asset.get_jsonpath(path)
+            # Add affixes if requested
+            if localization_value is not None and jp.add_affixes:
+                localization_value = prefix + localization_value + postfix
+            # Found a valid name, break
+            break
+        except AssetNotFoundError:
+            pass
+
+    # Try auto_naming using identifier
+    if (
+            localization_value is None and
+            auto_name in [True, "from_entity_name"]):
+        localization_value = prefix + format_name(identifier) + postfix
+
+    # If after all strategies no localization value was resolved, skip this asset.
+    if localization_value is None:
+        return None
+
+    return Translation(localization_key, localization_value, "")
+
+def gather_asset_translations(asset: JsonFileResource, identifier: str, name_sources: List[NameSource]) -> List[Tuple[int, Translation]]:
+    """
+    Gathers the translations of a single asset, resolving the names of every
+    source in order. Returns pairs of (source index, translation).
+    """
+    translations = []
+    for source_index, name_source in enumerate(name_sources):
+        translation = gather_translation(
+            name_source.asset_type,
+            asset,
+            identifier,
+            name_source.settings,
+            name_source.name_jsonpaths)
+        if translation is not None:
+            translations.append((source_index, translation))
+    return translations
+
+def gather_translations(assets: List[JsonFileResource], name_sources: List[NameSource], ignored_namespaces) -> List[List[Translation]]:
+    """
+    Gathers translations from the behavior pack.
+
+    The assets are walked once, resolving the names of every source for each
+    asset in the order of the sources. Returns a list of translations for
+    every source.
+    """
+    translations : List[List[Translation]] = [[] for _ in name_sources]
 
     for asset in assets:
         try:
@@ -82,45 +436,109 @@ def gather_translations(asset_type: str, assets: List[JsonFileResource], setting
         if identifier.split(':')[0] in ignored_namespaces:
             continue
 
-        localization_key = generate_localization_key(asset_type, asset)
+        for source_index, translation in gather_asset_translations(asset, identifier, name_sources):
+            translations[source_index].append(translation)
 
-        # Allow for generate_localization_key to return None (skip)
-        if localization_key is None:
-            continue
+    return translations
 
-        # Try loading localization_value from JSON paths
-        localization_value = None
-        for jp in name_jsonpaths:
-            path = jp.path
-            should_pop = jp.should_pop
+class AssetManifest:
+    """
+    Maps the content hash of every asset file to the translations gathered
+    from it, so that unchanged assets don't need to be parsed again on the
+    next run. Used by the incremental mode.
 
-            try:
-                # Pop the value if requested
-                if should_pop:
-                    localization_value = asset.pop_jsonpath(path)
+    Assets which had a name popped are saved in the 'assets' folder next to
+    the manifest, and copied back instead of being saved again.
+    """
+    def __init__(self, settings_hash: str) -> None:
+        self.settings_hash = settings_hash
+        self.entries = {}
+        self.new_entries = {}
+        try:
+            with open(MANIFEST_PATH, "r", encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        # The translations depend on the settings, nothing can be reused if
+        # they changed
+        if manifest.get("settings") == settings_hash:
+            self.entries = manifest.get("assets", {})
+
+    def gather_translations(self, assets: List[FastAsset], name_sources: List[NameSource], ignored_namespaces) -> List[List[Translation]]:
+        """
+        Same as 'gather_translations', but replays the translations of the
+        assets which didn't change since the previous run.
+        """
+        translations : List[List[Translation]] = [[] for _ in name_sources]
+
+        for asset in assets:
+            filepath = os.path.join(asset.pack_path, asset.filepath)
+            with open(filepath, "rb") as asset_file:
+                content_hash = hashlib.sha256(asset.identifier_path.encode() + b"\0" + asset_file.read()).hexdigest()
+
+            entry = self.entries.get(content_hash)
+            if entry is not None and entry["output"] is not None:
+                cached_asset = os.path.join(MANIFEST_ASSETS_PATH, f"{entry['output']}.json")
+                if os.path.isfile(cached_asset):
+                    shutil.copyfile(cached_asset, filepath)
                 else:
-                    localization_value = asset.get_jsonpath(path)
-                # Add affixes if requested
-                if localization_value is not None and jp.add_affixes:
-                    localization_value = prefix + localization_value + postfix
-                # Found a valid name, break
-                break
-            except AssetNotFoundError:
-                pass
-
-        # Try auto_naming using identifier
-        if (
-                localization_value is None and
-                auto_name in [True, "from_entity_name"]):
-            localization_value = prefix + format_name(identifier) + postfix
-
-        # If after all strategies no localization value was resolved, skip this asset.
-        if localization_value is None:
-            continue
-
-        translations.append(Translation(localization_key, localization_value, ""))
+                    entry = None
+            if entry is None:
+                entry = self.gather_asset(asset, name_sources, ignored_namespaces)
+            elif entry["identifier"] is None:
+                print(f"Warning: {asset.filepath} has no identifier, skipping...")
+
+            self.new_entries[content_hash] = entry
+            for source_index, key, value, comment in entry["translations"]:
+                translations[source_index].append(Translation(key, value, comment))
+
+        return translations
+
+    def gather_asset(self, asset: FastAsset, name_sources: List[NameSource], ignored_namespaces) -> dict:
+        """
+        Gathers the translations of an asset which isn't in the manifest, and
+        returns its new manifest entry.
+        """
+        entry = {"identifier": None, "translations": [], "output": None}
+        try:
+            identifier = asset.identifier
+        except AssetNotFoundError:
+            print(f"Warning: {asset.filepath} has no identifier, skipping...")
+            return entry
+        entry["identifier"] = identifier
 
-    return translations
+        # Skip assets that are in ignored namespaces (e.g. minecraft:zombie)
+        if identifier.split(':')[0] in ignored_namespaces:
+            return entry
+
+        entry["translations"] = [
+            [source_index, translation.key, translation.value, translation.comment]
+            for source_index, translation in gather_asset_translations(asset, identifier, name_sources)
+        ]
+        if asset.modified:
+            content = asset.dumps()
+            output_hash = hashlib.sha256(content.encode()).hexdigest()
+            Path(MANIFEST_ASSETS_PATH).mkdir(parents=True, exist_ok=True)
+            # Written the same way as the asset itself, so the copy is identical
+            with open(os.path.join(MANIFEST_ASSETS_PATH, f"{output_hash}.json"), "w+") as cached_asset:
+                cached_asset.write(content)
+            entry["output"] = output_hash
+        return entry
+
+    def save(self) -> None:
+        """
+        Saves the manifest of this run. Only the assets seen in this run are
+        kept, and the saved assets which are no longer referenced are removed.
+        """
+        Path(os.path.dirname(MANIFEST_PATH)).mkdir(parents=True, exist_ok=True)
+        with open(MANIFEST_PATH, "w", encoding='utf-8') as manifest_file:
+            json.dump({"settings": self.settings_hash, "assets": self.new_entries}, manifest_file, indent=4, ensure_ascii=False)
+
+        if os.path.isdir(MANIFEST_ASSETS_PATH):
+            referenced = {entry["output"] for entry in self.new_entries.values()}
+            for cached_asset in os.listdir(MANIFEST_ASSETS_PATH):
+                if os.path.splitext(cached_asset)[0] not in referenced:
+                    os.remove(os.path.join(MANIFEST_ASSETS_PATH, cached_asset))
 
 def main():
     """
@@ -153,72 +571,135 @@ def main():
 
     sort = settings.get("sort", False)
     ignored_namespaces = settings.get("ignored_namespaces", ['minecraft'])
-    project = Project("./BP", "./RP")
-    behavior_pack = project.behavior_pack
-    resource_pack = project.resource_pack
-
-    translations = []
-
-    translations.extend(
-        gather_translations(
-            AssetType.SPAWN_EGG,
-            behavior_pack.entities,
-            settings.get("spawn_eggs", {}),
-            [
-                # First try `spawn_egg_name` and pop it if found (no affixes)
-                NameJsonPath("minecraft:entity/description/spawn_egg_name", True, False),
-                # Fallback to entity name; add affixes only when auto_name == "from_entity_name"
-                NameJsonPath("minecraft:entity/description/name", False, settings.get("spawn_eggs", {}).get("auto_name") == "from_entity_name"),
-            ],
-            ignored_namespaces,
-        )
-    )
-
-    translations.extend(
-        gather_translations(
-            AssetType.ITEM,
-            behavior_pack.items,
-            settings.get("items", {}),
-            [NameJsonPath("minecraft:item/description/name", True, False)],
-            ignored_namespaces,
-        )
+    incremental = settings.get("incremental", False)
+    # The incremental mode replays the translations without parsing the
+    # assets, which is only possible with the fast mode
+    fast = settings.get("fast", False) or incremental
+    language_workers = settings.get("language_workers", 1)
+    profiler = Profiler("name_ninja", settings)
+
+    profiler.phase("load project")
+    if fast:
+        # Only the files which contain names are read, without loading them
+        # into a reticulator project
+        entities = load_fast_assets("./BP", "entities", "minecraft:entity/description/identifier")
+        items = load_fast_assets("./BP", "items", "minecraft:item/description/identifier")
+        blocks = load_fast_assets("./BP", "blocks", "minecraft:block/description/identifier")
+    else:
+        project = Project("./BP", "./RP")
+        behavior_pack = project.behavior_pack
+        resource_pack = project.resource_pack
+        entities = behavior_pack.entities
+        items = behavior_pack.items
+        blocks = behavior_pack.blocks
+
+    if incremental:
+        settings_hash = hashlib.sha256(json.dumps(
+            [settings.get(key) for key in ("spawn_eggs", "entities", "items", "blocks")] + [ignored_namespaces],
+            sort_keys=True).encode()).hexdigest()
+        manifest = AssetManifest(settings_hash)
+        gather = manifest.gather_translations
+    else:
+        gather = gather_translations
+
+    profiler.phase("gather translations")
+    profiler.read(len(entities) + len(items) + len(blocks))
+    # Spawn eggs and entity names are both gathered from the entities, in a
+    # single walk. The spawn egg is resolved first, as it may read the name
+    # before it's popped by the entity.
+    spawn_egg_translations, entity_translations = gather(
+        profiler.files(entities, path=asset_path),
+        [
+            NameSource(
+                AssetType.SPAWN_EGG,
+                settings.get("spawn_eggs", {}),
+                [
+                    # First try `spawn_egg_name` and pop it if found (no affixes)
+                    NameJsonPath("minecraft:entity/description/spawn_egg_name", True, False),
+                    # Fallback to entity name; add affixes only when auto_name == "from_entity_name"
+                    NameJsonPath("minecraft:entity/description/name", False, settings.get("spawn_eggs", {}).get("auto_name") == "from_entity_name"),
+                ],
+            ),
+            NameSource(
+                AssetType.ENTITY,
+                settings.get("entities", {}),
+                [NameJsonPath("minecraft:entity/description/name", True, False)],
+            ),
+        ],
+        ignored_namespaces,
     )
 
-    translations.extend(
-        gather_translations(
-            AssetType.BLOCK,
-            behavior_pack.blocks,
-            settings.get("blocks", {}),
-            [NameJsonPath("minecraft:block/description/name", True, False)],
-            ignored_namespaces,
-        )
+    item_translations, = gather(
+        profiler.files(items, path=asset_path),
+        [
+            NameSource(
+                AssetType.ITEM,
+                settings.get("items", {}),
+                [NameJsonPath("minecraft:item/description/name", True, False)],
+            ),
+        ],
+        ignored_namespaces,
     )
 
-    translations.extend(
-        gather_translations(
-            AssetType.ENTITY,
-            behavior_pack.entities,
-            settings.get("entities", {}),
-            [NameJsonPath("minecraft:entity/description/name", True, False)],
-            ignored_namespaces,
-        )
+    block_translations, = gather(
+        profiler.files(blocks, path=asset_path),
+        [
+            NameSource(
+                AssetType.BLOCK,
+                settings.get("blocks", {}),
+                [NameJsonPath("minecraft:block/description/name", True, False)],
+            ),
+        ],
+        ignored_namespaces,
     )
 
-    for language in languages:
-        try:
-            language_file = resource_pack.get_language_file(f"texts/{language}")
-        except AssetNotFoundError:
-            print(f"Warning: {language} file not found, creating...")
-            Path(os.path.join(resource_pack.input_path, 'texts')).mkdir(parents=True, exist_ok=True)
-            open(os.path.join(resource_pack.input_path, 'texts', language), 'a').close()
-            language_file = LanguageFile(filepath=f'texts/{language}', pack=resource_pack)
-
-        for translation in translations:
-            language_file.add_translation(translation, overwrite=overwrite)
-
-        if sort:
-            language_file.translations.sort(key=lambda t: t.key)
-
+    translations = [
+        *spawn_egg_translations,
+        *item_translations,
+        *block_translations,
+        *entity_translations,
+    ]
+    # The same batch is merged into every language file
+    translations_index = index_translations(translations)
+
+    profiler.phase("update language files")
+    profiler.read(len(languages))
+    if fast or language_workers > 1:
+        # The language files are updated directly, without reticulator
+        profiler.written(update_language_files(languages, translations, translations_index, overwrite, sort, language_workers))
+    else:
+        for language in languages:
+            try:
+                language_file = resource_pack.get_language_file(f"texts/{language}")
+            except AssetNotFoundError:
+                print(f"Warning: {language} file not found, creating...")
+                Path(os.path.join(resource_pack.input_path, 'texts')).mkdir(parents=True, exist_ok=True)
+                open(os.path.join(resource_pack.input_path, 'texts', language), 'a').close()
+                language_file = LanguageFile(filepath=f'texts/{language}', pack=resource_pack)
+
+            merged, added_count = merge_translations(
+                language_file.translations, translations, overwrite, translations_index)
+            # Same as add_translation, the file is only saved if something was added
+            if added_count > 0:
+                language_file.translations[:] = merged
+                language_file.dirty = True
+
+            if sort:
+                language_file.translations.sort(key=lambda t: t.key)
+            profiler.written(language_file.dirty)
+
+    profiler.phase("save assets")
+    if fast:
+        # Only the files which had a name popped are saved
+        for asset in entities + items + blocks:
+            if asset.modified:
+                asset.save()
+                profiler.written()
+        if incremental:
+            manifest.save()
+        return
+
+    profiler.written(sum(asset.dirty for asset in entities + items + blocks))
     project.save()
 
 if __name__ == "__main__":
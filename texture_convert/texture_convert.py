@@ -1,16 +1,69 @@
+import os
+import sys
+import json
+import math
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 import layeredimage.io
 import zipfile
-from PIL import Image, ImageSequence
+from blendmodes.blend import BlendType
+from layeredimage.io.common import blendModeLookup
+from layeredimage.layeredimage import LayeredImage
+from layeredimage.layergroup import Group, Layer
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.constants import BlendMode, ChannelID, Resource
+from psd_tools.psd import PSD
 
-def convert_kra(imgpath: Path):
+from file_index import FileIndex
+from profiler import Profiler
+
+SOURCE_PATHS = [Path("RP"), Path("BP")]
+CACHE_PATH = Path("data/texture_convert/cache")
+
+# The blend modes of psd-tools, mapped the same way as layeredimage does
+PSD_BLEND_MODES = {
+    BlendMode.NORMAL: BlendType.NORMAL,
+    BlendMode.MULTIPLY: BlendType.MULTIPLY,
+    BlendMode.COLOR_BURN: BlendType.COLOURBURN,
+    BlendMode.COLOR_DODGE: BlendType.COLOURDODGE,
+    BlendMode.OVERLAY: BlendType.OVERLAY,
+    BlendMode.DIFFERENCE: BlendType.DIFFERENCE,
+    BlendMode.SUBTRACT: BlendType.NEGATION,
+    BlendMode.LIGHTEN: BlendType.LIGHTEN,
+    BlendMode.DARKEN: BlendType.DARKEN,
+    BlendMode.SCREEN: BlendType.SCREEN,
+    BlendMode.SOFT_LIGHT: BlendType.SOFTLIGHT,
+    BlendMode.HARD_LIGHT: BlendType.HARDLIGHT,
+    BlendMode.EXCLUSION: BlendType.EXCLUSION,
+    BlendMode.HUE: BlendType.HUE,
+    BlendMode.SATURATION: BlendType.SATURATION,
+    BlendMode.COLOR: BlendType.COLOUR,
+    BlendMode.LUMINOSITY: BlendType.LUMINOSITY,
+    BlendMode.DIVIDE: BlendType.DIVIDE,
+    BlendMode.PIN_LIGHT: BlendType.PINLIGHT,
+    BlendMode.VIVID_LIGHT: BlendType.VIVIDLIGHT,
+}
+
+def convert_kra(imgpath: Path, source="preview"):
     '''
-    Converts a Krita file to a PNG.
+    Converts a Krita file to a PNG. The 'preview' source uses the preview
+    image, which may be downscaled. The 'merged' source uses the full
+    resolution merged image, and falls back to the preview when the file
+    doesn't contain one.
     '''
+    if source not in ("preview", "merged"):
+        raise ValueError(f"Unknown Krita source: {source}")
     # Krita files are actually zip files
     with zipfile.ZipFile(imgpath) as z:
-        with imgpath.with_suffix(".png").open("wb") as f2:
-            f2.write(z.read("preview.png"))
+        member = "preview.png"
+        if source == "merged" and "mergedimage.png" in z.namelist():
+            member = "mergedimage.png"
+        with z.open(member) as f1, imgpath.with_suffix(".png").open("wb") as f2:
+            shutil.copyfileobj(f1, f2)
 
 def convert_layered(imgpath: Path):
     '''
@@ -20,36 +73,259 @@ def convert_layered(imgpath: Path):
     img = layeredimage.io.openLayerImage(imgpath)
     img.getFlattenLayers().save(imgpath.with_suffix(".png"))
 
-def convert_gif(imgpath: Path):
+def psd_layered_image(psd: PSDImage) -> LayeredImage:
+    '''
+    Reads the layers of an already parsed PSD file into a layered image, the
+    same way as layeredimage.io.openLayerImage, which would parse the file
+    again.
+    '''
+    def layer_options(layer, left=0, top=0) -> dict:
+        return dict(
+            name=layer.name,
+            dimensions=(layer.width, layer.height),
+            offsets=(layer.left - left, layer.top - top),
+            opacity=layer.opacity / 255,
+            visible=layer.visible,
+            blendmode=blendModeLookup(layer.blend_mode, PSD_BLEND_MODES))
+
+    layers = []
+    for layer in psd:
+        if layer.is_group():
+            layers.append(Group(
+                layers=[
+                    Layer(image=child.topil(), **layer_options(child, layer.left, layer.top))
+                    for child in layer
+                ],
+                **layer_options(layer)))
+        else:
+            layers.append(Layer(image=layer.topil(), **layer_options(layer)))
+    return LayeredImage(layers, (psd.width, psd.height))
+
+def psd_composite_is_exact(psd: PSDImage, record: PSD) -> bool:
+    '''
+    Returns whether the merged image stored in a PSD file is the same as the
+    flattened layers, including the transparency.
+
+    The merged image only stores the transparency of the document when the
+    layer count of the file is negative. Otherwise it's opaque, which is only
+    right when the bottom layer is an opaque background that covers the whole
+    canvas.
     '''
-    Converts a GIF file to a PNG sprite sheet.
+    version_info = psd.image_resources.get_data(Resource.VERSION_INFO)
+    if version_info is None or not version_info.has_composite:
+        return False
+    if len(psd) == 0:
+        # Without layers, the merged image is the whole document
+        return True
+    layer_info = record.layer_and_mask_information.layer_info
+    if layer_info is None or not layer_info.layer_records:
+        # The layers are stored elsewhere (16 and 32 bit documents)
+        return False
+    if layer_info.layer_count < 0:
+        return True
+    bottom = layer_info.layer_records[0]
+    return (
+        bottom.flags.visible
+        and bottom.opacity == 255
+        and bottom.blend_mode == BlendMode.NORMAL
+        and (bottom.top, bottom.left, bottom.bottom, bottom.right)
+            == (0, 0, record.header.height, record.header.width)
+        and all(
+            channel.id != ChannelID.TRANSPARENCY_MASK
+            for channel in bottom.channel_info))
+
+def convert_psd(imgpath: Path, source="auto"):
+    '''
+    Converts a PSD file to a PNG. The 'composite' source uses the merged image
+    stored in the file (when saved with "Maximize Compatibility"), which is
+    much faster than flattening the layers. The 'layers' source flattens the
+    layers, like the other layered formats. The 'auto' source uses the
+    composite only when it's the same as the flattened layers, including the
+    transparency, and flattens the layers otherwise.
+    '''
+    if source not in ("auto", "composite", "layers"):
+        raise ValueError(f"Unknown PSD source: {source}")
+    with imgpath.open("rb") as f:
+        record = PSD.read(f)
+    psd = PSDImage(record)
+    if source == "auto":
+        source = "composite" if psd_composite_is_exact(psd, record) else "layers"
+    if source == "layers":
+        # The file is already parsed, so it's not opened with layeredimage
+        psd_layered_image(psd).getFlattenLayers().save(imgpath.with_suffix(".png"))
+        return
+    # psd-tools handles the transparency of the composite, which is stored
+    # blended over white
+    composite = psd.topil()
+    if composite is None:
+        raise ValueError("The PSD file doesn't contain a composite image")
+    composite = composite.convert("RGBA")
+    # The fully transparent pixels are left white by the blending, they are
+    # cleared like in the flattened layers
+    visible = composite.getchannel("A").point(lambda a: 255 if a else 0)
+    Image.composite(composite, Image.new("RGBA", composite.size), visible).save(
+        imgpath.with_suffix(".png"))
+
+def convert_gif(imgpath: Path, layout="vertical", frame_stride=1, max_frames=None):
+    '''
+    Converts a GIF file to a PNG sprite sheet. The frames are pasted into the
+    atlas one at a time, as they are decoded, so only a single frame is held
+    in memory next to the atlas.
     '''
     with Image.open(imgpath) as img:
-        frames = ImageSequence.all_frames(img)
+        frame_count = len(range(0, img.n_frames, frame_stride))
+        if max_frames is not None:
+            frame_count = min(frame_count, max_frames)
+        frame_width, frame_height = img.size
 
-    frame_width = frames[0].width
-    frame_height = frames[0].height
-    atlas_height = frame_height * len(frames)
+        if layout == "vertical":
+            columns, rows = 1, frame_count
+        elif layout == "grid":
+            columns = math.ceil(math.sqrt(frame_count))
+            rows = math.ceil(frame_count / columns)
+        else:
+            raise ValueError(f"Unknown GIF layout: {layout}")
 
-    # Create canvas for atlas
-    atlas = Image.new("RGBA", (frame_width, atlas_height))
+        # Create canvas for atlas
+        atlas = Image.new("RGBA", (frame_width * columns, frame_height * rows))
 
-    for index, frame in enumerate(frames):
-        atlas.paste(frame, (0, index * frame_height))
+        for index in range(frame_count):
+            img.seek(index * frame_stride)
+            atlas.paste(img, (
+                index % columns * frame_width,
+                index // columns * frame_height))
     atlas.save(imgpath.with_suffix(".png"))
 
 
+CONVERTERS = {
+    ".pdn": convert_layered,
+    ".xcf": convert_layered,
+    ".psd": convert_psd,
+    ".kra": convert_kra,
+    ".gif": convert_gif,
+}
+
+# The settings which are passed to the converters as keyword arguments
+CONVERTER_SETTINGS = {
+    ".kra": "kra",
+    ".gif": "gif",
+    ".psd": "psd",
+}
+
+def file_hash(path: Path) -> str:
+    '''
+    Returns the SHA-256 hash of the file content, reading it in chunks.
+    '''
+    sha = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def converter_options(suffix: str, settings: dict) -> dict:
+    '''
+    Returns the options from the filter settings, which should be passed to
+    the converter of the given file suffix.
+    '''
+    if suffix not in CONVERTER_SETTINGS:
+        return {}
+    return settings.get(CONVERTER_SETTINGS[suffix], {})
+
+def convert_file(imgpath: Path, settings: dict):
+    '''
+    Converts a file to a PNG and removes the source file. When the cache is
+    used, the PNG is copied from the cache if the same source file was
+    converted before.
+
+    Errors are returned instead of raised, so that a single broken file
+    doesn't stop the other files from being converted. Returns a tuple of
+    (cache_key, error).
+    '''
+    try:
+        converter = CONVERTERS[imgpath.suffix]
+        options = converter_options(imgpath.suffix, settings)
+        cache_key = None
+        if settings.get("cache", True):
+            cache_key = f"{converter.__name__}-{file_hash(imgpath)}"
+            if options:
+                # Different options produce different files
+                options_hash = hashlib.sha256(
+                    json.dumps(options, sort_keys=True).encode()).hexdigest()
+                cache_key += f"-{options_hash[:16]}"
+            cached_path = CACHE_PATH / f"{cache_key}.png"
+            if cached_path.exists():
+                shutil.copyfile(cached_path, imgpath.with_suffix(".png"))
+            else:
+                converter(imgpath, **options)
+                # Copy through a temporary file, as other workers may be
+                # converting a file with the same content
+                CACHE_PATH.mkdir(parents=True, exist_ok=True)
+                temp_path = CACHE_PATH / f"{cache_key}.{os.getpid()}.tmp"
+                shutil.copyfile(imgpath.with_suffix(".png"), temp_path)
+                os.replace(temp_path, cached_path)
+        else:
+            converter(imgpath, **options)
+        imgpath.unlink()
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    return cache_key, None
+
+def clean_cache(used_keys) -> None:
+    '''
+    Removes the cached files which weren't used in this run.
+    '''
+    if not CACHE_PATH.exists():
+        return
+    for cached_path in CACHE_PATH.iterdir():
+        if cached_path.stem not in used_keys:
+            cached_path.unlink()
+
+def main():
+    try:
+        settings = json.loads(sys.argv[1])
+    except IndexError:
+        settings = {}
+    workers = settings.get("workers", os.cpu_count() or 1)
+    profiler = Profiler("texture_convert", settings)
+
+    profiler.phase("list files")
+    index = FileIndex("texture_convert")
+    imgpaths = [
+        Path(entry.path)
+        for path in SOURCE_PATHS
+        for entry in index.files(path, CONVERTERS)
+    ]
+    # Saved before converting, the converted folders are listed again by the
+    # next filter
+    index.save()
+
+    profiler.phase("convert files")
+    convert = partial(convert_file, settings=settings)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            converted = profiler.map(executor.map, convert, imgpaths)
+    else:
+        converted = profiler.map(map, convert, imgpaths)
+    results = [
+        (imgpath, cache_key, error)
+        for imgpath, (cache_key, error) in zip(imgpaths, converted)
+    ]
+    profiler.read(len(imgpaths))
+    profiler.written(sum(error is None for _, _, error in results))
+
+    if settings.get("cache", True):
+        profiler.phase("clean cache")
+        clean_cache({cache_key for _, cache_key, _ in results})
+
+    errors = sorted(
+        (imgpath, error) for imgpath, _, error in results if error is not None)
+    if errors:
+        print(f"Failed to convert {len(errors)} file(s):")
+        for imgpath, error in errors:
+            print(f"    {imgpath.as_posix()}: {error}")
+        sys.exit(1)
+
+
 # EXECUTE SCRIPT
 if __name__ == "__main__":
-    for imgpath in Path(".").rglob("*"):
-        if not imgpath.is_file():
-            continue
-        if imgpath.suffix in [".pdn", ".xcf", ".psd"]:
-            convert_layered(imgpath)
-            imgpath.unlink()
-        elif imgpath.suffix == ".kra":
-            convert_kra(imgpath)
-            imgpath.unlink()
-        elif imgpath.suffix == ".gif":
-            convert_gif(imgpath)
-            imgpath.unlink()
\ No newline at end of file
+    main()
@@ -0,0 +1,181 @@
+"""
+A cached index of the files of the packs, used by the filters which look
+for textures.
+
+The folders are listed with os.scandir, and the listing of every folder is
+saved in the data folder of the filter (data/<filter>/file_index.json),
+together with the modification time of the folder. The data folder of the
+filter is exported back to the project by Regolith, so the index is kept
+between runs. Adding, removing or renaming a file changes the modification
+time of its folder, so on the next run, only the folders which changed are
+listed again.
+
+Some file systems only store the modification time with a coarse precision
+(a second or more), so a folder changed in the same tick as it was listed
+would keep the same modification time. Like git does for its index, folders
+whose modification time isn't safely older than their listing are "racy",
+and always listed again.
+
+The size and modification time of the files are the ones of the last listing
+of their folder. Editing a file in place doesn't change the modification time
+of its folder, so they may be out of date.
+
+Filters are installed individually, so an identical copy of this module is
+shipped with every filter that uses it.
+"""
+
+import os
+import json
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+DATA_PATH = Path("data")
+INDEX_NAME = "file_index.json"
+# Increased when the format of the saved index changes
+INDEX_VERSION = 2
+# A folder listed less than this long after its modification time may be
+# changed again without changing its modification time. Two seconds cover
+# the precision of FAT, HFS+ and most network file systems.
+RACY_NS = 2_000_000_000
+
+
+class FileEntry(NamedTuple):
+    # The path of the file, relative to the working directory
+    path: str
+    suffix: str
+    size: int
+    mtime: int
+
+
+def scan_folder(folder: str) -> dict:
+    """
+    Lists a single folder. The files are grouped by suffix, as lists of
+    [name, size, mtime]. The time of the listing is saved as 'scanned'.
+    """
+    scanned = time.time_ns()
+    files = {}
+    folders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                folders.append(entry.name)
+                continue
+            stat = entry.stat()
+            suffix = os.path.splitext(entry.name)[1]
+            files.setdefault(suffix, []).append(
+                [entry.name, stat.st_size, stat.st_mtime_ns])
+    return {"files": files, "folders": folders, "scanned": scanned}
+
+
+def is_racy(state: dict) -> bool:
+    """
+    Whether the folder may have changed after it was listed, without changing
+    its modification time.
+    """
+    return state["scanned"] - state["mtime"] < RACY_NS
+
+
+class FileIndex:
+    """
+    The index of the files of the packs, saved in the data folder of the
+    filter with the given name. The folders are listed when they are first
+    queried, and the index is only written when 'save' is called.
+    """
+    def __init__(self, name: str) -> None:
+        self.path = DATA_PATH / name / INDEX_NAME
+        self.folders: Dict[str, dict] = {}
+        try:
+            with open(self.path, "r") as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                self.folders = index["folders"]
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        self.visited = set()
+        self.roots = set()
+
+    def walk(self, root: Union[str, Path]) -> Iterable[Tuple[str, dict]]:
+        """
+        Yields the path and the state of every folder under the root
+        (included). Folders whose modification time changed since they were
+        listed, or which are racy, are listed again.
+        """
+        root = Path(root).as_posix()
+        self.roots.add(root)
+        folders = [root]
+        while folders:
+            folder = folders.pop()
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+                state = self.folders.get(folder)
+                if state is None or state["mtime"] != mtime or is_racy(state):
+                    state = scan_folder(folder)
+                    state["mtime"] = mtime
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self.folders[folder] = state
+            self.visited.add(folder)
+            yield folder, state
+            folders.extend(f"{folder}/{name}" for name in state["folders"])
+
+    def files(
+            self, root: Union[str, Path],
+            suffixes: Optional[Iterable[str]] = None,
+            ignore_case: bool = False) -> List[FileEntry]:
+        """
+        Lists the files under the root. When suffixes are given, only the
+        files with one of the suffixes are listed.
+        """
+        if suffixes is not None:
+            suffixes = {s.lower() if ignore_case else s for s in suffixes}
+        result = []
+        for folder, state in self.walk(root):
+            for suffix, files in state["files"].items():
+                key = suffix.lower() if ignore_case else suffix
+                if suffixes is not None and key not in suffixes:
+                    continue
+                result.extend(
+                    FileEntry(f"{folder}/{name}", suffix, size, mtime)
+                    for name, size, mtime in files)
+        return result
+
+    def add_file(self, path: Union[str, Path]) -> None:
+        """
+        Records a file written by the filter into a folder it listed in this
+        run. Creating the file changes the modification time of the folder,
+        which is updated too. The folder was just modified, so it's racy, and
+        listed again on the next run.
+        """
+        path = Path(path)
+        folder = path.parent.as_posix()
+        if folder not in self.visited:
+            return
+        state = self.folders[folder]
+        stat = path.stat()
+        files = state["files"].setdefault(os.path.splitext(path.name)[1], [])
+        files[:] = [file for file in files if file[0] != path.name]
+        files.append([path.name, stat.st_size, stat.st_mtime_ns])
+        state["mtime"] = os.stat(folder).st_mtime_ns
+
+    def save(self) -> None:
+        """
+        Saves the index to the data folder. The folders under the walked roots
+        which weren't visited no longer exist, and are removed from the index.
+        """
+        def walked(folder: str) -> bool:
+            return any(
+                folder == root or folder.startswith(root + "/")
+                for root in self.roots)
+
+        folders = {
+            folder: state for folder, state in self.folders.items()
+            if folder in self.visited or not walked(folder)
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Written through a temporary file, so that a filter which is stopped
+        # never leaves a broken index for the next one
+        temp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "folders": folders}, f)
+        os.replace(temp_path, self.path)
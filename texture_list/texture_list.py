@@ -1,9 +1,14 @@
+import os
+import sys
 import json
-from itertools import chain
 from pathlib import Path
 
+from file_index import FileIndex
+from profiler import Profiler
+
 ROOT_PATH = Path("RP")
 SUBPACK_PATH = ROOT_PATH / "subpacks"
+TEXTURE_SUFFIXES = {".png", ".tga"}
 
 
 def fetch_subpack_folders():
@@ -15,36 +20,72 @@ def fetch_subpack_folders():
             if subpack_folder.is_dir() and (subpack_folder / "textures").exists():
                 yield subpack_folder
 
-def list_textures(root_folder: Path):
+def list_textures(root_folder: Path, index: FileIndex):
     """
     Lists all textures within the 'textures' folder within the path. For example
     pass in 'RP", and it will search 'RP/textures'.
-    """
-    textures = []
-    textures_folder = root_folder / "textures"
 
-    for texture in chain(textures_folder.glob("**/*.png"), textures_folder.glob("**/*.tga")):
-        textures.append(texture.relative_to(root_folder).with_suffix("").as_posix())
-    return textures
+    The files are listed from the file index, collecting all texture types at
+    the same time. Folders which didn't change since they were last listed
+    are not listed again.
+    """
+    root = root_folder.as_posix()
+    return [
+        os.path.splitext(os.path.relpath(entry.path, root))[0].replace(os.sep, "/")
+        for entry in index.files(root_folder / "textures", TEXTURE_SUFFIXES, ignore_case=True)
+    ]
 
-def generate_texture_list_file(root_folder: Path, textures):
+def generate_texture_list_file(root_folder: Path, textures, index: FileIndex):
     """
     Generates root_folder/textures/textures_list.json
+
+    The file is only written if its content changed, and is then added to the
+    file index. Returns whether it was written.
     """
     if len(textures) > 0:
-        with open(root_folder / "textures" / "textures_list.json", "w") as f:
-            json.dump(textures, f, indent='\t')
+        path = root_folder / "textures" / "textures_list.json"
+        content = json.dumps(textures, indent='\t')
+        try:
+            with open(path, "r") as f:
+                if f.read() == content:
+                    return False
+        except FileNotFoundError:
+            pass
+        with open(path, "w") as f:
+            f.write(content)
+        index.add_file(path)
+        return True
+    return False
 
 
 def main():
+    try:
+        settings = json.loads(sys.argv[1])
+    except IndexError:
+        settings = {}
+
+    profiler = Profiler("texture_list", settings)
+    index = FileIndex("texture_list")
+
     # Handle the root resource pack file
-    pack_textures = list_textures(ROOT_PATH);
-    generate_texture_list_file(ROOT_PATH, pack_textures)
+    profiler.phase("generate pack list")
+    # The listed textures are counted as read in the profile
+    textures = list_textures(ROOT_PATH, index)
+    profiler.read(len(textures))
+    pack_textures = sorted(set(textures))
+    profiler.written(generate_texture_list_file(ROOT_PATH, pack_textures, index))
+
+    # The textures of the root pack are listed in every subpack as well. Every
+    # subpack is timed as a file in the profile.
+    profiler.phase("generate subpack lists")
+    for subpack_folder in profiler.files(fetch_subpack_folders()):
+        textures = list_textures(subpack_folder, index)
+        profiler.read(len(textures))
+        subpack_textures = sorted(set(textures).union(pack_textures))
+        profiler.written(generate_texture_list_file(subpack_folder, subpack_textures, index))
 
-    for subpack_folder in fetch_subpack_folders():
-        # list+set is a way of crushing duplicates out of a list
-        subpack_textures = list(set(list_textures(subpack_folder) + pack_textures))
-        generate_texture_list_file(subpack_folder, subpack_textures)
+    profiler.phase("save index")
+    index.save()
 
 if __name__ == "__main__":
     """